@@ -0,0 +1,107 @@
+# built in
+import threading
+import sqlite3
+import queue
+import os
+
+# seconds a connection waits on a locked database before giving up
+busy_timeout = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 30))
+
+# prepared statements kept per connection, reused by parameterized queries
+cached_statements = 256
+
+# connections of the current thread, keyed by database path
+local = threading.local()
+
+# process-wide idle connections, keyed by database path, for servers that
+# start a new thread per request and would never reuse a thread-local one
+pools = {}
+pools_lock = threading.Lock()
+
+# idle connections kept per database path
+pool_size = int(os.environ.get("SQLITE_POOL_SIZE", 8))
+
+
+def configure(connection):
+    """
+    Switches a connection to WAL, so readers never block the writer and
+    the frontend keeps serving while an evaluator commits.
+    """
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.execute("PRAGMA synchronous=NORMAL;")
+    connection.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)};")
+    return connection
+
+
+def get(path):
+    """
+    Returns this thread's connection to path, opening it on first use.
+    Meant for long-lived threads such as the evaluators'; see borrow().
+    Connections stay open for the life of the thread, so every
+    "with Database(...)" block reuses one connection and its statement cache.
+    """
+    connections = getattr(local, "connections", None)
+    if connections is None:
+        connections = local.connections = {}
+    if path not in connections:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(path, timeout=busy_timeout, cached_statements=cached_statements)
+        connections[path] = configure(connection)
+    return connections[path]
+
+
+def borrow(path):
+    """
+    Takes an idle connection to path from the process-wide pool, opening
+    and configuring a new one only when none is idle. Give it back with
+    release() once done; it may then be used from any thread.
+    """
+    with pools_lock:
+        pool = pools.setdefault(path, queue.LifoQueue())
+    try:
+        return pool.get_nowait()
+    except queue.Empty:
+        pass
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(
+        path,
+        timeout=busy_timeout,
+        cached_statements=cached_statements,
+        check_same_thread=False
+    )
+    return configure(connection)
+
+
+def release(path, connection):
+    """
+    Returns a borrowed connection to the pool, closing it if the pool is full.
+    """
+    with pools_lock:
+        pool = pools.setdefault(path, queue.LifoQueue())
+    if pool.qsize() < pool_size:
+        pool.put(connection)
+    else:
+        connection.close()
+
+
+def close():
+    """
+    Closes every connection of the current thread.
+    """
+    for connection in getattr(local, "connections", {}).values():
+        connection.close()
+    local.connections = {}
+
+
+def forget():
+    # sqlite connections must not be shared with a forked child
+    global pools
+    local.connections = {}
+    pools = {}
+
+
+os.register_at_fork(after_in_child=forget)
@@ -0,0 +1,184 @@
+# built in
+import sqlite3
+import datetime
+import time
+import os
+
+# custom
+import connections
+
+# logging
+import logging
+
+
+class JobQueue:
+    """
+    Durable submission queue shared by the frontend and the evaluators.
+    The frontend puts a job when a submission is saved; each evaluator
+    claims jobs for its own challenge and blocks while there are none.
+    """
+    def __init__(self, path):
+        # path to file
+        self.path = path
+
+        # whether we're connected or not
+        self.connection = None
+
+        # create the table if none exists
+        self.__enter__()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS Jobs
+            (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                challenge TEXT NOT NULL,
+                team TEXT NOT NULL,
+                submission TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                created TEXT NOT NULL,
+                updated TEXT
+            );
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS JobsByStatus ON Jobs (challenge, status, id);"
+        )
+        self.__exit__(None, None, None)
+
+    def __enter__(self):
+        """
+        Enables the "with X as Y:" syntax
+        """
+        if not self.connection:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # autocommit, transactions are opened explicitly where needed
+            self.connection = sqlite3.connect(self.path, timeout=connections.busy_timeout, isolation_level=None)
+            connections.configure(self.connection)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Defines what to do when "with X as Y:" closes
+        """
+        if not self.connection:
+            return
+        else:
+            self.connection.close()
+            self.connection = None
+
+    def put(self, challenge, team, submission):
+        now = datetime.datetime.now().isoformat()
+        cursor = self.connection.execute(
+            "INSERT INTO Jobs (challenge, team, submission, created) VALUES (?, ?, ?, ?);",
+            (challenge, team, submission, now)
+        )
+        return cursor.lastrowid
+
+    def claim(self, challenges):
+        """
+        Marks the oldest pending job as running and returns it, or None if
+        there is nothing to do.
+        Inputs:
+            challenges: String or list; a challenge, or challenges in
+                priority order, highest first
+        Outputs:
+            job: dictionary or None; id, challenge, team and submission
+        """
+        if isinstance(challenges, str):
+            challenges = [challenges]
+        row = None
+        self.connection.execute("BEGIN IMMEDIATE;")
+        try:
+            for challenge in challenges:
+                row = self.connection.execute(
+                    "SELECT id, challenge, team, submission FROM Jobs WHERE challenge = ? AND status = 'pending' ORDER BY id LIMIT 1;",
+                    (challenge,)
+                ).fetchone()
+                if row:
+                    self.set_status(row[0], 'running')
+                    break
+            self.connection.execute("COMMIT;")
+        except Exception:
+            self.connection.execute("ROLLBACK;")
+            raise
+        if not row:
+            return None
+        return {
+            "id": row[0],
+            "challenge": row[1],
+            "team": row[2],
+            "submission": row[3]
+        }
+
+    def get(self, challenges, timeout=None, interval=1):
+        """
+        Blocks until a job for challenges is available and claims it.
+        Between attempts only PRAGMA data_version is polled, which changes
+        when another connection commits, so idle evaluators never take
+        the write lock.
+        Inputs:
+            challenges: String or list; see claim
+            timeout: float; seconds to wait, None waits forever
+            interval: float; seconds between data_version checks
+        Outputs:
+            job: dictionary or None; id, challenge, team and submission
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            version = self.data_version()
+            job = self.claim(challenges)
+            if job:
+                return job
+            while self.data_version() == version:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(interval)
+
+    def data_version(self):
+        return self.connection.execute("PRAGMA data_version;").fetchone()[0]
+
+    def set_status(self, job_id, status):
+        now = datetime.datetime.now().isoformat()
+        self.connection.execute(
+            "UPDATE Jobs SET status = ?, updated = ? WHERE id = ?;",
+            (status, now, job_id)
+        )
+
+    def done(self, job_id):
+        self.set_status(job_id, 'done')
+
+    def fail(self, job_id):
+        self.set_status(job_id, 'failed')
+
+    def reset(self, challenges):
+        """
+        Puts jobs left running by a previous, crashed evaluator back in the queue.
+        """
+        if isinstance(challenges, str):
+            challenges = [challenges]
+        for challenge in challenges:
+            self.connection.execute(
+                "UPDATE Jobs SET status = 'pending' WHERE challenge = ? AND status = 'running';",
+                (challenge,)
+            )
+
+
+def serve(challenges, handler, path="db/jobs.sqlite3"):
+    """
+    Runs handler(job) for every job queued for challenges, forever.
+    With several challenges, pending jobs are taken in their priority order.
+    """
+    with JobQueue(path) as queue:
+        queue.reset(challenges)
+        while True:
+            job = queue.get(challenges)
+            logging.info(f"Job {job['id']}: {job['team']} {job['submission']}")
+            try:
+                handler(job)
+            except Exception as e:
+                logging.error(f"Job {job['id']} failed: {e}")
+                queue.fail(job["id"])
+                continue
+            queue.done(job["id"])
@@ -0,0 +1,107 @@
+# built in
+from collections import OrderedDict
+from contextlib import contextmanager
+from zipfile import ZipFile
+import os
+
+# 3rd party
+import rasterio
+from rasterio.io import MemoryFile
+
+# members of a kept zip are addressed as <archive>!<member>
+separator = "!"
+
+# open archives, keyed by path, one set per process; pool workers never
+# see Images close, so only the most recently used few are kept open
+archives = OrderedDict()
+max_open = 4
+
+
+def get_archive(path):
+    if path in archives:
+        archives.move_to_end(path)
+    else:
+        archives[path] = ZipFile(path)
+        while len(archives) > max_open:
+            _, archive = archives.popitem(last=False)
+            archive.close()
+    return archives[path]
+
+
+def close(path=None):
+    """
+    Closes the archive at path, or every open archive.
+    """
+    paths = list(archives) if path is None else [path]
+    for archive_path in paths:
+        archive = archives.pop(archive_path, None)
+        if archive is not None:
+            archive.close()
+
+
+@contextmanager
+def open_raster(path):
+    """
+    Opens a chip with rasterio, either from disk or, for <archive>!<member>
+    paths, straight out of the zip through an in-memory file.
+    """
+    if separator not in path:
+        with rasterio.open(path) as src:
+            yield src
+        return
+    archive_path, member = path.split(separator, 1)
+    with get_archive(archive_path).open(member) as incoming:
+        data = incoming.read()
+    with MemoryFile(data) as memory_file:
+        with memory_file.open() as src:
+            yield src
+
+
+class Images:
+    """
+    The images of a submission folder, either extracted to images/ or kept
+    in submission.zip when the frontend does not extract them. Use it as a
+    context manager so the zip is closed once the submission is scored.
+    """
+    def __init__(self, folder, lowercase=False):
+        self.root = os.path.join(folder, "images")
+        self.archive = os.path.join(folder, "submission.zip")
+        # fire and estimation file names are compared lowercase
+        self.lowercase = lowercase
+        self.zipped = not os.path.isdir(self.root) and os.path.exists(self.archive)
+        # relative path -> zip member or file on disk, None when names are
+        # used as they are
+        self.members = None
+        if self.zipped:
+            with ZipFile(self.archive) as archive:
+                names = [name for name in archive.namelist() if not name.endswith('/')]
+            self.members = {(name.lower() if lowercase else name): name for name in names}
+        elif lowercase and os.path.isdir(self.root):
+            self.members = {}
+            for root, dirs, files in os.walk(self.root):
+                for f in files:
+                    name = os.path.relpath(os.path.join(root, f), self.root)
+                    self.members[name.lower()] = name
+
+    def path(self, *parts):
+        """
+        Returns the path of an image, relative to images/, that open_raster
+        can read.
+        """
+        relative = os.path.join(*parts)
+        if self.members is not None:
+            key = relative.lower() if self.lowercase else relative
+            relative = self.members.get(key, relative)
+        if not self.zipped:
+            return os.path.join(self.root, relative)
+        return f"{self.archive}{separator}{relative}"
+
+    def close(self):
+        if self.zipped:
+            close(self.archive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,142 @@
+# built in
+import os
+import json
+
+# custom
+from config import config
+from database import Database
+import truth_cache
+
+# logging
+import logging
+
+
+def cache_version(challenge, truth=None):
+    """
+    Returns the version content-addressed scores are stored under: the
+    challenge's metric version, the float precision and, when given, the
+    hash of the truth tree, so changing any of them invalidates old scores.
+    """
+    version = f"{config['metric_versions'][challenge]}-{config['precision']['dtype']}"
+    if truth is not None:
+        version = f"{version}-{truth_cache.tree_hash(truth)}"
+    return version
+
+
+class Checkpoint:
+    """
+    Chip-level progress of one submission, kept in the ChipScores table.
+    Chips scored by an earlier, interrupted run are returned by lookup(), as
+    are chips whose content (sha1 from the frontend's hashes.json) was
+    already scored against the same truth chip in any earlier submission.
+    New scores are written in batches of `every` chips.
+    """
+    def __init__(self, challenge, team, submission, every=None, path="db/db.sqlite3", hashes=None, version=None, truth=None, lowercase=False):
+        self.challenge = challenge
+        self.team = team
+        self.submission = submission
+        self.path = path
+        if every is None:
+            every = config["checkpoint"]["every"]
+        self.every = max(1, every)
+        if version is None:
+            version = cache_version(challenge, truth)
+        self.version = version
+        # submitted file, relative to images/ -> sha1
+        self.hashes = hashes or {}
+        # fire and estimation hashes.json keys are lowercase
+        self.lowercase = lowercase
+        # chip -> sha1 of the file it was scored from
+        self.chip_hashes = {}
+        self.pending = {}
+        with Database(self.path) as db:
+            self.done = db.get_chip_scores(challenge, team, submission)
+        if self.done:
+            logging.info(f"Resuming {team}/{submission} with {len(self.done)} chips already scored")
+        # content-addressed scores, looked up lazily per chip
+        self.cached = None
+
+    @classmethod
+    def for_folder(cls, challenge, folder, **kwargs):
+        """
+        Builds the checkpoint of a submissions/valid/<challenge>/<team>/<submission>
+        folder, picking up the chip hashes written by the frontend.
+        """
+        folder = os.path.abspath(folder)
+        team = os.path.basename(os.path.dirname(folder))
+        hashes_path = os.path.join(folder, "hashes.json")
+        if "hashes" not in kwargs and os.path.exists(hashes_path):
+            with open(hashes_path) as incoming:
+                kwargs["hashes"] = json.load(incoming)
+        return cls(challenge, team, os.path.basename(folder), **kwargs)
+
+    def __contains__(self, chip):
+        return chip in self.done or chip in self.pending
+
+    def get(self, chip):
+        if chip in self.pending:
+            return self.pending[chip]
+        return self.done.get(chip)
+
+    def hash_of(self, path):
+        return self.hashes.get(path.lower() if self.lowercase else path)
+
+    def load_cached(self, chips, paths=None):
+        """
+        Fetches the content-addressed scores of chips in one query.
+        Inputs:
+            chips: list; chip keys
+            paths: list; submitted file of each chip, relative to images/,
+                defaults to the chip keys themselves
+        """
+        pairs = []
+        for chip, path in zip(chips, paths or chips):
+            sha1 = self.hash_of(path)
+            if sha1:
+                self.chip_hashes[chip] = sha1
+                pairs.append((chip, sha1))
+        if self.cached is None:
+            self.cached = {}
+        if not pairs:
+            return
+        with Database(self.path) as db:
+            self.cached.update(db.get_cached_scores(self.challenge, self.version, pairs))
+
+    def lookup(self, chip):
+        """
+        Returns the scores of chip if it was scored before, either in this
+        submission or, by content hash (see load_cached), in any other;
+        otherwise None.
+        """
+        if chip in self:
+            return self.get(chip)
+        if self.cached is None:
+            return None
+        sha1 = self.chip_hashes.get(chip)
+        scores = self.cached.get((chip, sha1)) if sha1 else None
+        if scores is not None:
+            self.add(chip, scores)
+        return scores
+
+    def add(self, chip, scores, path=None):
+        if chip not in self.chip_hashes:
+            sha1 = self.hash_of(path or chip)
+            if sha1:
+                self.chip_hashes[chip] = sha1
+        self.pending[chip] = scores
+        if len(self.pending) >= self.every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        hashed = {
+            (chip, self.chip_hashes[chip]): scores
+            for chip, scores in self.pending.items()
+            if chip in self.chip_hashes
+        }
+        with Database(self.path) as db:
+            db.save_chip_scores(self.challenge, self.team, self.submission, self.pending)
+            db.save_score_cache(self.challenge, self.version, hashed)
+        self.done.update(self.pending)
+        self.pending = {}
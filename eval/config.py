@@ -0,0 +1,79 @@
+# built in
+import os
+
+# settings for the evaluators, overridable from the environment
+matrix_completion = {
+    # chips per LPIPS forward pass
+    "lpips_batch_size": int(os.environ.get("LPIPS_BATCH_SIZE", 32)),
+    # torch intra-op threads, 0 keeps torch's default
+    "torch_threads": int(os.environ.get("TORCH_THREADS", 0)),
+    # chips per Inception forward pass for FID
+    "fid_batch_size": int(os.environ.get("FID_BATCH_SIZE", 64)),
+    # dtype of the memory-mapped truth LPIPS features, float16 halves the
+    # cache (about 2.5MB per chip in float32) at a small cost in accuracy
+    "lpips_cache_dtype": os.environ.get("LPIPS_CACHE_DTYPE", "float32"),
+}
+
+parallel = {
+    # processes used to score chips, 0 uses every core
+    "workers": int(os.environ.get("EVAL_WORKERS", 0)),
+}
+
+precision = {
+    # float dtype chips are decoded to, and SSIM / PSNR / MSE computed in,
+    # for matrix completion and translation; "float64" restores the previous
+    # full precision. The LPIPS and Inception networks always run in float32
+    "dtype": os.environ.get("EVAL_PRECISION", "float32"),
+}
+
+checkpoint = {
+    # chips scored between writes to the ChipScores table
+    "every": int(os.environ.get("CHECKPOINT_EVERY", 100)),
+}
+
+# bump a challenge's version whenever its scoring changes, so scores
+# cached by submission content hash are not reused across versions
+metric_versions = {
+    "estimation": 1,
+    "fire": 1,
+    "translation": 1,
+    "matrix_completion": 1,
+}
+
+daemon = {
+    # challenges served by daemon.py, highest priority first
+    "challenges": os.environ.get(
+        "EVAL_CHALLENGES",
+        "fire,estimation,translation,matrix_completion"
+    ).split(","),
+}
+
+mail = {
+    # "gmail" sends through the Gmail API with token.json, "smtp" sends to
+    # smtp_host:smtp_port, e.g. a local debugging server while testing
+    "backend": os.environ.get("MAIL_BACKEND", "gmail"),
+    "smtp_host": os.environ.get("SMTP_HOST", "localhost"),
+    "smtp_port": int(os.environ.get("SMTP_PORT", 1025)),
+    "sender": os.environ.get("MAIL_FROM", "multiearth.evals@gmail.com"),
+    "cc": os.environ.get("MAIL_CC", "multiearth2023@gmail.com"),
+    # queued results emails, sent by a background thread
+    "outbox": os.environ.get("MAIL_OUTBOX", "db/outbox.sqlite3"),
+    # messages per Gmail batch request / SMTP session
+    "batch_size": int(os.environ.get("MAIL_BATCH_SIZE", 20)),
+    # attempts before a message is marked failed
+    "max_attempts": int(os.environ.get("MAIL_MAX_ATTEMPTS", 8)),
+    # seconds before the first retry, doubled on every further attempt
+    "backoff": float(os.environ.get("MAIL_BACKOFF", 30)),
+    "max_backoff": float(os.environ.get("MAIL_MAX_BACKOFF", 3600)),
+}
+
+
+config = {
+    "matrix_completion": matrix_completion,
+    "parallel": parallel,
+    "precision": precision,
+    "checkpoint": checkpoint,
+    "metric_versions": metric_versions,
+    "daemon": daemon,
+    "mail": mail,
+}
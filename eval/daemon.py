@@ -0,0 +1,69 @@
+# built in
+import importlib
+
+# logging, configured before the evaluators so lines keep their module name
+import logging
+logging.basicConfig(
+    filename="eval.log",
+    format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%dT%H:%M:%S%z"
+)
+
+# custom
+from config import config
+import jobs
+import mail
+import parallel
+
+# evaluator module per challenge; each one provides main() to scan its
+# submissions folder and handle_job(job) to evaluate a queued submission
+evaluators = {
+    "fire": "fire",
+    "estimation": "estimation",
+    "translation": "translation",
+    "matrix_completion": "matrix",
+}
+
+
+def load_evaluators(challenges):
+    """
+    Imports the evaluator module of every challenge, in priority order.
+    Heavy models (LPIPS, Inception) are cached by those modules, so they
+    are loaded once for the life of the daemon.
+    """
+    output = {}
+    for challenge in challenges:
+        if challenge not in evaluators:
+            logging.error(f"No evaluator for {challenge}")
+            continue
+        output[challenge] = importlib.import_module(evaluators[challenge])
+    return output
+
+
+def main(challenges=None):
+    if challenges is None:
+        challenges = config["daemon"]["challenges"]
+    loaded = load_evaluators(challenges)
+
+    def handle_job(job):
+        loaded[job["challenge"]].handle_job(job)
+
+    # send results emails left queued by a previous run
+    mail.start()
+    try:
+        # pick up anything saved while no evaluator was running
+        for challenge, module in loaded.items():
+            logging.info(f"Startup scan: {challenge}")
+            # a failed scan must not keep the daemon from serving jobs
+            try:
+                module.main()
+            except Exception as e:
+                logging.error(f"Startup scan of {challenge} failed: {e}")
+        jobs.serve(list(loaded), handle_job)
+    finally:
+        parallel.shutdown()
+
+
+if __name__ == '__main__':
+    main()
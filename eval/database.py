@@ -1,7 +1,35 @@
 # built in
-import sqlite3
 import os
 
+# custom
+import connections
+
+# databases already checked for tables added after launch
+migrated = set()
+
+
+def leaderboard_version_path(path):
+    """
+    File next to the database whose content changes whenever a leaderboard
+    does; the frontend only re-reads scores when it changes.
+    """
+    return os.path.join(os.path.dirname(path), "leaderboard.version")
+
+
+def bump_leaderboard_version(path):
+    version_path = leaderboard_version_path(path)
+    try:
+        with open(version_path) as incoming:
+            version = int(incoming.read())
+    except (FileNotFoundError, ValueError):
+        version = 0
+    # replaced atomically, readers never see a partial write
+    temp_path = f"{version_path}.{os.getpid()}"
+    with open(temp_path, 'w') as output:
+        output.write(str(version + 1))
+    os.replace(temp_path, version_path)
+
+
 class Database:
     def __init__(self, path):
         # path to file
@@ -11,16 +39,23 @@ class Database:
         self.connection = None
         self.cursor = None
 
+        # whether a leaderboard table was written in this block
+        self.leaderboard_changed = False
+
         # create the database if none exists
         if not os.path.exists(self.path):
             self.create_database()
+        elif self.path not in migrated:
+            self.create_chip_scores()
+        migrated.add(self.path)
 
     def __enter__(self):
         """
         Enables the "with X as Y:" syntax
         """
         if not self.connection:
-            self.connection = sqlite3.connect(self.path)
+            # pooled per thread, WAL with a busy timeout
+            self.connection = connections.get(self.path)
             self.cursor = self.connection.cursor()
         return self
 
@@ -32,16 +67,28 @@ class Database:
             return
         else:
             self.connection.commit()
-            self.connection.close()
+            # the connection stays open for the next block on this thread
+            self.cursor.close()
             self.connection = None
             self.cursor = None
+            if self.leaderboard_changed:
+                bump_leaderboard_version(self.path)
+                self.leaderboard_changed = False
 
-    def query(self, query_string):
-        self.cursor.execute(query_string)
+    def query(self, query_string, params=()):
+        self.cursor.execute(query_string, params)
         return self.cursor.fetchall()
 
+    def update_leaderboard(self, query_string, params=()):
+        """
+        Runs a write to a leaderboard table, e.g. a team's new best score,
+        and invalidates the frontend's cached leaderboards on commit.
+        """
+        self.leaderboard_changed = True
+        return self.query(query_string, params)
+
     def get_top_matrix_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM MatrixCompletionScores ORDER BY lpips ASC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM MatrixCompletionScores ORDER BY lpips ASC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -55,7 +102,7 @@ class Database:
         return output
 
     def get_top_estimation_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM EstimationScores ORDER BY pixel DESC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM EstimationScores ORDER BY pixel DESC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -68,7 +115,7 @@ class Database:
         return output
 
     def get_top_translation_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM ImageToImageScores ORDER BY score ASC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM ImageToImageScores ORDER BY score ASC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -80,35 +127,38 @@ class Database:
     
 
     def get_translation_score_by_team(self, team):
-        self.cursor.execute(f"SELECT score from ImageToImageScores WHERE team = '{team}';")
+        self.cursor.execute("SELECT score from ImageToImageScores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO ImageToImageScores (team, score) VALUES ('{team}', 1);")
+            self.cursor.execute("INSERT INTO ImageToImageScores (team, score) VALUES (?, 1);", (team,))
+            self.leaderboard_changed = True
             return 1
         else:
             return results[0][0]
         
 
     def get_completion_score_by_team(self, team):
-        self.cursor.execute(f"SELECT lpips FROM matrixcompletionscores WHERE team = '{team}';")
+        self.cursor.execute("SELECT lpips FROM matrixcompletionscores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO matrixcompletionscores (team, lpips, psnr, ssim) VALUES ('{team}', 1, 0, 0);")
+            self.cursor.execute("INSERT INTO matrixcompletionscores (team, lpips, psnr, ssim) VALUES (?, 1, 0, 0);", (team,))
+            self.leaderboard_changed = True
             return 1
         else:
             return results[0][0]
 
     def get_estimation_score_by_team(self, team):
-        self.cursor.execute(f"SELECT pixel from EstimationScores WHERE team = '{team}';")
+        self.cursor.execute("SELECT pixel from EstimationScores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO EstimationScores (team, pixel, f1, iou) VALUES ('{team}', 0, 0, 0);")
+            self.cursor.execute("INSERT INTO EstimationScores (team, pixel, f1, iou) VALUES (?, 0, 0, 0);", (team,))
+            self.leaderboard_changed = True
             return 1
         else:
             return results[0][0]
         
     def get_top_estimation_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM FireScores ORDER BY pixel DESC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM FireScores ORDER BY pixel DESC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -121,14 +171,120 @@ class Database:
         return output
 
     def get_fire_score_by_team(self, team):
-        self.cursor.execute(f"SELECT pixel from FireScores WHERE team = '{team}';")
+        self.cursor.execute("SELECT pixel from FireScores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO FireScores (team, pixel, f1, iou) VALUES ('{team}', 0, 0, 0);")
+            self.cursor.execute("INSERT INTO FireScores (team, pixel, f1, iou) VALUES (?, 0, 0, 0);", (team,))
+            self.leaderboard_changed = True
             return 1
         else:
             return results[0][0]
 
+    def save_chip_scores(self, challenge, team, submission, chip_scores):
+        """
+        Bulk inserts per-chip scores, one row per metric.
+        Inputs:
+            challenge: String; e.g. "estimation" or "matrix_completion"
+            team: String; team name
+            submission: String; submission folder name
+            chip_scores: dictionary; chip -> {metric: value}
+        """
+        rows = [
+            (challenge, team, submission, chip, metric, float(value))
+            for chip, scores in chip_scores.items()
+            for metric, value in scores.items()
+            if value is not None
+        ]
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO ChipScores (challenge, team, submission, chip, metric, value) VALUES (?, ?, ?, ?, ?, ?);",
+            rows
+        )
+
+    def get_chip_scores(self, challenge, team, submission):
+        """
+        Returns {chip: {metric: value}} for one submission.
+        """
+        self.cursor.execute(
+            "SELECT chip, metric, value FROM ChipScores WHERE challenge = ? AND team = ? AND submission = ?;",
+            (challenge, team, submission)
+        )
+        output = {}
+        for chip, metric, value in self.cursor.fetchall():
+            output.setdefault(chip, {})[metric] = value
+        return output
+
+    def save_score_cache(self, challenge, version, hashed_scores):
+        """
+        Bulk inserts content-addressed scores.
+        Inputs:
+            challenge: String; challenge name
+            version: String; see checkpoint.cache_version
+            hashed_scores: dictionary; (truth chip, submission sha1) -> {metric: value}
+        """
+        rows = [
+            (challenge, chip, sha1, version, metric, float(value))
+            for (chip, sha1), scores in hashed_scores.items()
+            for metric, value in scores.items()
+            if value is not None
+        ]
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO ScoreCache (challenge, chip, hash, version, metric, value) VALUES (?, ?, ?, ?, ?, ?);",
+            rows
+        )
+
+    def get_cached_scores(self, challenge, version, pairs):
+        """
+        Returns {(truth chip, submission sha1): {metric: value}} for every
+        pair that was scored before, by any team.
+        """
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS Lookup (chip TEXT, hash TEXT);")
+        self.cursor.execute("DELETE FROM Lookup;")
+        self.cursor.executemany("INSERT INTO Lookup (chip, hash) VALUES (?, ?);", pairs)
+        self.cursor.execute(
+            """
+            SELECT s.chip, s.hash, s.metric, s.value FROM ScoreCache s
+            JOIN Lookup l ON s.chip = l.chip AND s.hash = l.hash
+            WHERE s.challenge = ? AND s.version = ?;
+            """,
+            (challenge, version)
+        )
+        output = {}
+        for chip, sha1, metric, value in self.cursor.fetchall():
+            output.setdefault((chip, sha1), {})[metric] = value
+        return output
+
+    def create_chip_scores(self):
+        self.__enter__()
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ChipScores
+            (
+                challenge TEXT NOT NULL,
+                team TEXT NOT NULL,
+                submission TEXT NOT NULL,
+                chip TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (challenge, team, submission, chip, metric)
+            );
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ScoreCache
+            (
+                challenge TEXT NOT NULL,
+                chip TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                version TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (challenge, chip, hash, version, metric)
+            );
+            """
+        )
+        self.__exit__(None, None, None)
+
     def create_database(self):
         self.__enter__()
         table_creation = [
@@ -171,3 +327,4 @@ class Database:
         for command in table_creation:
             self.cursor.execute(command)
         self.__exit__(None, None, None)
+        self.create_chip_scores()
@@ -1,5 +1,4 @@
-nohup python /app/matrix.py &
-nohup python /app/estimation.py &
-nohup python /app/translation.py &
-nohup python /app/fire.py &
-tail -f /app/eval.log
+# follow the log in the background, the daemon is PID 1 so a crash
+# stops the container and docker-compose restarts it
+tail -F /app/eval.log &
+exec python /app/daemon.py
@@ -6,16 +6,19 @@ import time
 import sys
 
 # 3rd party
-from schedule import every, repeat, run_pending
-from PIL import Image
-from sklearn.metrics import f1_score
 import numpy as np
 from sklearn.preprocessing import normalize
 import rasterio
 
 # custom
 from database import Database
+import jobs
 import mail
+import scoring
+import truth_cache
+import parallel
+import archive
+from checkpoint import Checkpoint
 
 # logging
 import logging
@@ -26,90 +29,68 @@ logging.basicConfig(
     datefmt="%Y-%m-%dT%H:%M:%S%z"
 )
 
-def get_pixel_accuracy(truth, submission):
-    pixels = []
-    for x in range(truth.width):
-        for y in range(truth.height):
-            coordinates = (x, y)
-            true_pixel = truth.getpixel(coordinates)
-            pred_pixel = submission.getpixel(coordinates)
-            if true_pixel == pred_pixel:
-                pixels.append(1)
-            else:
-                pixels.append(0)
-    accuracy = sum(pixels) / len(pixels)
-    accuracy = accuracy * 100
-    return accuracy
-
-def get_f1_score(truth, submission, chip):
-    truth = np.array(truth)
-    truth = truth.flatten()
-    submission = np.array(submission)
-    submission = submission.flatten()
-    logging.info(chip)
-    score = 0
-    try:
-        score = f1_score(truth, submission, zero_division=1, pos_label=1)
-    except:
-        logging.error(np.unique(truth))
-        logging.error(np.unique(submission))
-        logging.error(chip)
-        raise ValueError("oops")
-    return score
-
-
-def get_iou(truth, submission):
-    """
-    Logical not is a applied because the mask is black pixels, so it 
-    must be inverted after casting to numpy array
-    """
-    truth = np.array(truth, dtype=bool)
-    # truth = np.logical_not(truth)
-    submission = np.array(submission, dtype=bool)
-    # submission = np.logical_not(submission)
-    overlap = truth * submission
-    union  = truth + submission
-    iou = overlap.sum() / float(union.sum())
-    if np.isnan(iou):
-        iou = 1
-    return iou
-
 def norm_image(z):
     immax = np.max(z)
     immin = np.min(z)
     norm_z = (z-immin)/(immax-immin)
-    norm_z = norm_z
-    norm_z = Image.fromarray(np.uint8(norm_z))
+    norm_z = np.uint8(norm_z)
     return norm_z
 
 
-def eval_date(submission_folder, truth_folder):
-    output = {}
-    chips = [f for f in os.listdir(truth_folder) if '.tiff' in f]
-    for chip in chips:
-        # truth
-        truth_path = os.path.join(truth_folder, chip)
+def score_chip(task):
+    """
+    Scores a single chip, run inside the worker pool.
+    Inputs:
+        task: tuple; (chip, truth path, cached truth mask or None, submission path)
+    Outputs:
+        scores: dictionary; accuracy, f1 and iou
+    """
+    chip, truth_path, truth_image, submission_path = task
+    # truth
+    if truth_image is None:
         truth_image = rasterio.open(truth_path).read()[0]
         truth_image = norm_image(truth_image)
 
-        # submission
-        submission_path = os.path.join(submission_folder, chip)
-        submission_image = rasterio.open(submission_path).read()[0]
-        submission_image = norm_image(submission_image)
+    # submission
+    with archive.open_raster(submission_path) as src:
+        submission_image = src.read()[0]
+    submission_image = norm_image(submission_image)
 
-        # pixel accuracy
-        accuracy = get_pixel_accuracy(truth_image, submission_image)
-        f1 = get_f1_score(truth_image, submission_image, chip)
-        iou = get_iou(truth_image, submission_image)
+    # pixel accuracy, f1 and iou
+    logging.info(chip)
+    return scoring.get_scores(truth_image, submission_image, chip)
 
-        scores = {
-            "accuracy": accuracy,
-            "f1": f1,
-            "iou": iou
-        }
 
+def eval_date(images, truth_folder, truth_masks=None, checkpoint=None, date=''):
+    output = {}
+    chips = [f for f in os.listdir(truth_folder) if '.tiff' in f]
+    # chips finished by an interrupted run are not scored again
+    # and neither are chips whose exact content was scored before
+    todo = chips
+    if checkpoint is not None:
+        keys = [os.path.join(date, chip) for chip in chips]
+        checkpoint.load_cached(keys)
+        todo = [chip for chip, key in zip(chips, keys) if checkpoint.lookup(key) is None]
+    tasks = []
+    for chip in todo:
+        truth_path = os.path.join(truth_folder, chip)
+        truth_image = None
+        if truth_masks is not None and truth_path in truth_masks:
+            truth_image = truth_masks.get(truth_path)
+        submission_path = images.path(date, chip)
+        tasks.append((chip, truth_path, truth_image, submission_path))
+    # results come back in chip order
+    scored = {}
+    for chip, scores in zip(todo, parallel.imap(score_chip, tasks)):
         logging.info(scores)
-        output[chip] = scores
+        scored[chip] = scores
+        if checkpoint is not None:
+            checkpoint.add(os.path.join(date, chip), scores)
+    for chip in chips:
+        if chip in scored:
+            output[chip] = scored[chip]
+        else:
+            output[chip] = checkpoint.get(os.path.join(date, chip))
     # get averages
     accuracies = [v["accuracy"] for v in output.values()]
     f1s = [v["f1"] for v in output.values()]
@@ -135,27 +116,35 @@ def eval_submission(folder, truth_folder="/app/truth/estimation"):
     final = os.path.basename(folder)
     logging.info(f"Evaluating {final}")
 
-    dates = os.listdir(truth_folder)
-    # averages
-    accuracies = []
-    f1s = []
-    ious = []
-    if all(['.tiff' in date for date in dates]):
-        scores = eval_date(os.path.join(folder, 'images'), truth_folder)
-        output['all'] = scores
-        accuracies.append(scores["accuracy"])
-        f1s.append(scores["f1"])
-        ious.append(scores["iou"])
-    else:
-        for date in dates:
-            truth_path = os.path.join(truth_folder, date)
-            submission_path = os.path.join(folder, 'images', date)
-            logging.info(f'Evaluating date: {date}')
-            scores = eval_date(submission_path, truth_path)
-            output[date] = scores
+    # packed truth masks, only rebuilt when a truth file changes
+    truth_masks = truth_cache.load(truth_folder, "cache/truth/estimation", norm_image)
+
+    # chip scores are written in batches, so a restart resumes mid-submission
+    checkpoint = Checkpoint.for_folder("estimation", folder, truth=truth_folder, lowercase=True)
+
+    # extracted images, or the kept zip read without extracting
+    with archive.Images(folder, lowercase=True) as images:
+        dates = os.listdir(truth_folder)
+        # averages
+        accuracies = []
+        f1s = []
+        ious = []
+        if all(['.tiff' in date for date in dates]):
+            scores = eval_date(images, truth_folder, truth_masks, checkpoint)
+            output['all'] = scores
             accuracies.append(scores["accuracy"])
             f1s.append(scores["f1"])
             ious.append(scores["iou"])
+        else:
+            for date in dates:
+                truth_path = os.path.join(truth_folder, date)
+                logging.info(f'Evaluating date: {date}')
+                scores = eval_date(images, truth_path, truth_masks, checkpoint, date)
+                output[date] = scores
+                accuracies.append(scores["accuracy"])
+                f1s.append(scores["f1"])
+                ious.append(scores["iou"])
+        checkpoint.flush()
     if accuracies:
         output["accuracy"] = sum(accuracies) / len(accuracies)
     else:
@@ -182,27 +171,36 @@ def eval_submission(folder, truth_folder="/app/truth/estimation"):
     return output
 
 
+def update_best(team, scores):
+    """
+    Puts a submission's scores on the leaderboard if they beat the team's best.
+    """
+    with Database('db/db.sqlite3') as db:
+        previous_best = db.get_estimation_score_by_team(team)
+        if scores["accuracy"] > previous_best:
+            db.update_leaderboard(
+                "UPDATE EstimationScores SET pixel = ?, f1 = ?, iou = ? WHERE team = ?",
+                (scores["accuracy"], scores['f1'], scores['iou'], team)
+            )
+
+
 def eval_team(folder, team):
     submissions = [f for f in os.listdir(folder)]
-    accuracy = 0
-    best = {}
     logging.info(submissions)
     for submission in submissions:
         full_path = os.path.join(folder, submission)
-        scores = eval_submission(full_path)
+        # a broken submission must not keep the rest of the team from being scored
+        try:
+            scores = eval_submission(full_path)
+        except Exception as e:
+            logging.error(f"{full_path}: {e}")
+            continue
         if not scores:
             continue
         logging.info(f"Accuracy: {scores['accuracy']} F1: {scores['f1']} IOU: {scores['iou']}")
-        if scores["accuracy"] > accuracy:
-            best = scores
-            accuracy = scores["accuracy"]
-        with Database('db/db.sqlite3') as db:
-            previous_best = db.get_estimation_score_by_team(team)
-            if accuracy > previous_best:
-                db.query(f"UPDATE EstimationScores SET pixel = {accuracy}, f1 = {best['f1']}, iou = {best['iou']} WHERE team = '{team}'")
+        update_best(team, scores)
 
         
-@repeat(every(60).seconds)
 def main(path="/app/submissions/valid/estimation"):
     os.makedirs(path, exist_ok=True)
     logging.info("Starting scan")
@@ -215,7 +213,18 @@ def main(path="/app/submissions/valid/estimation"):
     logging.info("Done with scan")
 
 
+def handle_job(job, path="/app/submissions/valid/estimation"):
+    # only the queued submission; failures are left to jobs.serve
+    team = job["team"]
+    logging.info(f"Evaluating team: {team}; submission: {job['submission']}")
+    scores = eval_submission(os.path.join(path, team, job["submission"]))
+    if not scores:
+        return
+    logging.info(f"Accuracy: {scores['accuracy']} F1: {scores['f1']} IOU: {scores['iou']}")
+    update_best(team, scores)
+
+
 if __name__ == '__main__':
-    while True:
-        run_pending()
-        time.sleep(1)
+    # pick up anything saved while no evaluator was running
+    main()
+    jobs.serve("estimation", handle_job)
@@ -0,0 +1,167 @@
+# built in
+import os
+import hashlib
+
+# 3rd party
+import numpy as np
+import torch
+from torch.nn.functional import adaptive_avg_pool2d
+from pytorch_fid import fid_score
+from pytorch_fid.inception import InceptionV3
+
+# custom
+from config import config
+
+# logging
+import logging
+
+# inception models, keyed by (dims, device)
+models = {}
+
+# content hashes, keyed by folder and a (name, size, mtime) signature
+folder_hashes = {}
+
+
+def get_model(dims=2048, device="cpu"):
+    """
+    Returns the InceptionV3 feature extractor, loaded once per process.
+    """
+    key = (dims, device)
+    if key not in models:
+        block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[dims]
+        models[key] = InceptionV3([block_idx]).to(device)
+        models[key].eval()
+    return models[key]
+
+
+def folder_hash(folder):
+    """
+    Takes in a folder and returns the sha1 of its file names and contents.
+    The hash is memoized against the folder's (name, size, mtime) listing,
+    so unchanged folders are only read once per process.
+    """
+    names = sorted(f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)))
+    signature = []
+    for name in names:
+        stat = os.stat(os.path.join(folder, name))
+        signature.append((name, stat.st_size, stat.st_mtime))
+    signature = tuple(signature)
+    cached = folder_hashes.get(folder)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha1()
+    for name in names:
+        digest.update(name.encode())
+        with open(os.path.join(folder, name), 'rb') as incoming:
+            for block in iter(lambda: incoming.read(1 << 20), b''):
+                digest.update(block)
+    folder_hashes[folder] = (signature, digest.hexdigest())
+    return folder_hashes[folder][1]
+
+
+class Activations:
+    """
+    Collects Inception activations for already decoded, normalized chips.
+    Chips are buffered into batches of batch_size, which on a GPU are
+    staged through a reused pinned buffer and copied asynchronously.
+    """
+    def __init__(self, model, device="cpu", batch_size=None):
+        self.model = model
+        self.device = device
+        if batch_size is None:
+            batch_size = config["matrix_completion"]["fid_batch_size"]
+        self.batch_size = max(1, batch_size)
+        self.pending = []
+        self.batches = []
+        # pinned staging buffer, only used for cuda devices
+        self.buffer = None
+
+    def add(self, images):
+        """
+        Takes in a list of normalized (H, W) arrays and stores their activations.
+        """
+        self.pending.extend(images)
+        while len(self.pending) >= self.batch_size:
+            self.run(self.pending[:self.batch_size])
+            del self.pending[:self.batch_size]
+
+    def flush(self):
+        if self.pending:
+            self.run(self.pending)
+            self.pending = []
+
+    def stage(self, images):
+        """
+        Stacks images into a (B, 1, H, W) float32 tensor on the device.
+        """
+        count = len(images)
+        shape = (self.batch_size,) + np.shape(images[0])
+        if not str(self.device).startswith("cuda"):
+            batch = torch.from_numpy(np.stack(images, dtype=np.float32))
+            return batch.unsqueeze(1)
+        if self.buffer is None or tuple(self.buffer.shape) != shape:
+            self.buffer = torch.empty(shape, dtype=torch.float32, pin_memory=True)
+        np.stack(images, out=self.buffer[:count].numpy())
+        return self.buffer[:count].to(self.device, non_blocking=True).unsqueeze(1)
+
+    def run(self, images):
+        with torch.inference_mode():
+            # single band chips are fed to inception as grey RGB, expanded
+            # after the copy so only one band is transferred
+            batch = self.stage(images).expand(-1, 3, -1, -1)
+            pred = self.model(batch)[0]
+            if pred.size(2) != 1 or pred.size(3) != 1:
+                pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+            # copying back also waits for the staged copy, so the pinned
+            # buffer can be reused by the next batch
+            self.batches.append(pred.squeeze(3).squeeze(2).cpu().numpy())
+
+    def statistics(self):
+        """
+        Returns the mean and covariance of every activation added so far.
+        """
+        self.flush()
+        act = np.concatenate(self.batches)
+        mu = np.mean(act, axis=0)
+        sigma = np.cov(act, rowvar=False)
+        return mu, sigma
+
+
+def stats_path(folder, dims=2048, cache_folder="cache/fid"):
+    key = folder_hash(folder)
+    name = os.path.basename(os.path.normpath(folder))
+    return os.path.join(cache_folder, f"{name}-{dims}-{key}.npz")
+
+
+def cached_truth_statistics(folder, dims=2048, cache_folder="cache/fid"):
+    """
+    Returns the persisted (mu, sigma) of a truth folder, or None if the
+    folder's current contents have not been seen before.
+    """
+    path = stats_path(folder, dims, cache_folder)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as stats:
+        return stats["mu"], stats["sigma"]
+
+
+def save_truth_statistics(folder, mu, sigma, dims=2048, cache_folder="cache/fid"):
+    """
+    Persists the (mu, sigma) of a truth folder, keyed by its content hash.
+    """
+    path = stats_path(folder, dims, cache_folder)
+    logging.info(f"Saving FID statistics for {folder}")
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as outgoing:
+        np.savez(outgoing, mu=mu, sigma=sigma)
+    os.replace(tmp_path, path)
+
+
+def frechet_distance(truth_stats, submission_stats):
+    """
+    Takes in two (mu, sigma) pairs and returns the FID between them.
+    """
+    truth_mu, truth_sigma = truth_stats
+    mu, sigma = submission_stats
+    return fid_score.calculate_frechet_distance(truth_mu, truth_sigma, mu, sigma)
@@ -0,0 +1,190 @@
+# built in
+import glob
+import json
+import os
+import shutil
+
+# 3rd party
+import numpy as np
+import torch
+import lpips
+
+# custom
+from config import config
+import fid_stats
+
+# logging
+import logging
+
+# open truth feature caches, keyed by cache path
+loaded = {}
+
+
+def layer_features(lpips_fn, batch):
+    """
+    Takes in a (B, 3, H, W) batch scaled to [-1, 1] and returns the
+    channel-normalized AlexNet activations LPIPS compares, one per layer.
+    Same steps as lpips.LPIPS.forward up to the per-layer differences.
+    """
+    outs = lpips_fn.net.forward(lpips_fn.scaling_layer(batch))
+    return [lpips.normalize_tensor(out) for out in outs]
+
+
+def distances(lpips_fn, submission_features, truth_features):
+    """
+    Takes in the layer_features of two batches and returns the LPIPS
+    distance of every pair, as lpips.LPIPS.forward would.
+    """
+    total = 0
+    for kk, (feat0, feat1) in enumerate(zip(submission_features, truth_features)):
+        total = total + lpips_fn.lins[kk]((feat0 - feat1) ** 2).mean([2, 3], keepdim=True)
+    return total.flatten().tolist()
+
+
+def cache_path(folder, cache_folder="cache/lpips"):
+    key = fid_stats.folder_hash(folder)
+    name = os.path.basename(os.path.normpath(folder))
+    precision = config["precision"]["dtype"]
+    return os.path.join(cache_folder, f"{name}-{precision}-{key}")
+
+
+class TruthFeatures:
+    """
+    Memory-mapped LPIPS features of every truth chip in one dataset folder,
+    one (N, C, H, W) .npy file per AlexNet layer plus an index.json of
+    chip -> row. While building, rows are filled in as chips are scored.
+    """
+    def __init__(self, path, files, mode='r', shapes=None, dtype=None):
+        self.path = path
+        self.files = list(files)
+        self.index = {f: i for i, f in enumerate(self.files)}
+        self.mode = mode
+        self.dtype = dtype
+        self.layers = None
+        self.written = set()
+        if shapes is not None:
+            self.open(shapes)
+
+    def open(self, shapes):
+        self.layers = [
+            np.lib.format.open_memmap(
+                os.path.join(self.path, f"layer{kk}.npy"),
+                mode=self.mode,
+                dtype=self.dtype,
+                shape=(len(self.files),) + tuple(shape) if self.mode == 'w+' else None
+            )
+            for kk, shape in enumerate(shapes)
+        ]
+
+    def __contains__(self, f):
+        return f in self.index
+
+    def get(self, files, device):
+        """
+        Returns the cached features of files, in order, as float32 tensors.
+        """
+        rows = [self.index[f] for f in files]
+        return [
+            torch.from_numpy(np.ascontiguousarray(layer[rows], dtype=np.float32)).to(device)
+            for layer in self.layers
+        ]
+
+    def put(self, files, features):
+        """
+        Stores the layer_features of files while the cache is being built.
+        """
+        if self.layers is None:
+            self.open([feature.shape[1:] for feature in features])
+        rows = [self.index[f] for f in files]
+        for layer, feature in zip(self.layers, features):
+            layer[rows] = feature.cpu().numpy()
+        self.written.update(files)
+
+    def complete(self):
+        return self.layers is not None and len(self.written) == len(self.files)
+
+
+def load(folder, cache_folder="cache/lpips"):
+    """
+    Returns the TruthFeatures of a truth folder, or None if its current
+    contents have not been cached yet.
+    """
+    path = cache_path(folder, cache_folder)
+    if path in loaded:
+        return loaded[path]
+    index_path = os.path.join(path, "index.json")
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as incoming:
+        index = json.load(incoming)
+    features = TruthFeatures(path, index["files"])
+    features.open(index["shapes"])
+    loaded[path] = features
+    return features
+
+
+def builder(folder, files, cache_folder="cache/lpips"):
+    """
+    Starts a cache for a truth folder in a temporary directory; pass it to
+    save() once every chip has been put.
+    """
+    path = cache_path(folder, cache_folder)
+    remove_stale(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    dtype = np.dtype(config["matrix_completion"]["lpips_cache_dtype"])
+    return TruthFeatures(tmp_path, files, mode='w+', dtype=dtype)
+
+
+def remove_stale(path):
+    """
+    Removes builds of path left by processes that are no longer running,
+    e.g. an evaluator that crashed or was restarted mid-build.
+    """
+    for tmp_path in glob.glob(f"{glob.escape(path)}.*.tmp"):
+        try:
+            pid = int(tmp_path[len(path) + 1:-len(".tmp")])
+        except ValueError:
+            continue
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            logging.info(f"Removing stale LPIPS build {tmp_path}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        except PermissionError:
+            # alive, owned by someone else
+            pass
+
+
+def discard(features):
+    """
+    Throws away a cache that is still being built.
+    """
+    features.layers = None
+    shutil.rmtree(features.path, ignore_errors=True)
+
+
+def save(folder, features, cache_folder="cache/lpips"):
+    """
+    Publishes a fully built cache; incomplete ones are thrown away.
+    """
+    if not features.complete():
+        logging.info(f"LPIPS truth features for {folder} are incomplete, not caching")
+        discard(features)
+        return
+    logging.info(f"Saving LPIPS truth features for {folder}")
+    shapes = [list(layer.shape[1:]) for layer in features.layers]
+    for layer in features.layers:
+        layer.flush()
+    features.layers = None
+    with open(os.path.join(features.path, "index.json"), 'w') as outgoing:
+        outgoing.write(json.dumps({"files": features.files, "shapes": shapes}))
+    path = cache_path(folder, cache_folder)
+    try:
+        os.replace(features.path, path)
+    except OSError:
+        # another process published the same cache first
+        shutil.rmtree(features.path, ignore_errors=True)
@@ -1,6 +1,8 @@
 # built in
 import base64
 import os
+import smtplib
+import threading
 from email.message import EmailMessage
 
 # 3rd party
@@ -9,16 +11,36 @@ from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+# custom
+from config import config
+from outbox import Outbox
+
 # logging
 import logging
 
 # Based on https://developers.google.com/gmail/api/guides/sending
 
+# authorized credentials and Gmail client, reused for every message
+creds = None
+service = None
+client_lock = threading.Lock()
+
+# background sender of this process, started by the first queued message
+sender = None
+sender_lock = threading.Lock()
+wake = threading.Event()
+
+# seconds a claimed message is left alone before another sender retries it
+lease = 300
+
+
 def get_creds():
+    global creds
+    if creds and creds.valid:
+        return creds
     folder = os.path.dirname(os.path.abspath(__file__))
     creds_path = os.path.join(folder, 'token.json')
-    creds = None
-    if os.path.exists('token.json'):   
+    if not creds and os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file(
             creds_path,
             scopes=[
@@ -40,38 +62,195 @@ def get_creds():
     return creds
 
 
-def send_mail(body, to, subject="MultiEarth Eval Update"):
-    creds = get_creds()
-    #delegated_creds = creds.with_subject('multiearth.evals@gmail.com')
-    service = build("gmail", 'v1', credentials=creds)
+def get_service():
+    """
+    Returns the Gmail client, built once per process. Its credentials are
+    only refreshed, and the client only rebuilt, once they have expired.
+    """
+    global service
+    with client_lock:
+        current = creds
+        authorized = get_creds()
+        if service is None or authorized is not current:
+            #delegated_creds = creds.with_subject('multiearth.evals@gmail.com')
+            service = build("gmail", 'v1', credentials=authorized, cache_discovery=False)
+        return service
+
+
+def create_message(body, to, subject):
     message = EmailMessage()
 
     message.set_content(body)
 
+    if not isinstance(to, str):
+        to = ", ".join(to)
     message['To'] = to
-    message['From'] = 'multiearth.evals@gmail.com'
-    message['Cc'] = 'multiearth2023@gmail.com'
+    message['From'] = config["mail"]["sender"]
+    if config["mail"]["cc"]:
+        message['Cc'] = config["mail"]["cc"]
     message['Subject'] = subject
+    return message
+
+
+def send_gmail(messages):
+    """
+    Sends messages in one Gmail batch request.
+    Inputs:
+        messages: list; dictionaries of id, recipients, subject and body
+    Outputs:
+        errors: dictionary; message id -> exception, for messages not sent
+    """
+    client = get_service()
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[int(request_id)] = exception
+
+    batch = client.new_batch_http_request(callback=callback)
+    for item in messages:
+        message = create_message(item["body"], item["recipients"], item["subject"])
+        # encoded message
+        encoded_message = base64.urlsafe_b64encode(message.as_bytes()) \
+            .decode()
+        batch.add(
+            client.users().messages().send(
+                userId="me",
+                body={
+                    'raw': encoded_message
+                }
+            ),
+            request_id=str(item["id"])
+        )
+    batch.execute()
+    return errors
+
+
+def send_smtp(messages):
+    """
+    Sends messages over one SMTP session to config["mail"]["smtp_host"].
+    Inputs:
+        messages: list; dictionaries of id, recipients, subject and body
+    Outputs:
+        errors: dictionary; message id -> exception, for messages not sent
+    """
+    errors = {}
+    with smtplib.SMTP(config["mail"]["smtp_host"], config["mail"]["smtp_port"], timeout=30) as smtp:
+        for item in messages:
+            message = create_message(item["body"], item["recipients"], item["subject"])
+            try:
+                smtp.send_message(message)
+            except smtplib.SMTPException as e:
+                errors[item["id"]] = e
+    return errors
+
+
+backends = {
+    "gmail": send_gmail,
+    "smtp": send_smtp,
+}
+
+
+def send_batch(messages):
+    return backends[config["mail"]["backend"]](messages)
+
+
+def send_mail(body, to, subject="MultiEarth Eval Update"):
+    """
+    Sends one message right away, bypassing the outbox.
+    """
+    errors = send_batch([{"id": 0, "recipients": to, "subject": subject, "body": body}])
+    if errors:
+        raise errors[0]
+
+
+def backoff(attempts):
+    delay = config["mail"]["backoff"] * 2 ** (attempts - 1)
+    return min(delay, config["mail"]["max_backoff"])
+
+
+def drain(outbox):
+    """
+    Sends one batch of due messages and records how each one went.
+    Inputs:
+        outbox: Outbox; open outbox
+    Outputs:
+        claimed: int; number of messages attempted
+    """
+    messages = outbox.claim(config["mail"]["batch_size"], lease)
+    if not messages:
+        return 0
+    try:
+        errors = send_batch(messages)
+    except Exception as e:
+        # the whole batch failed, e.g. no connection or bad credentials
+        errors = {item["id"]: e for item in messages}
+    for item in messages:
+        error = errors.get(item["id"])
+        if error is None:
+            outbox.sent(item["id"])
+            logging.info(f"Sent mail {item['id']}: {item['subject']}")
+        elif item["attempts"] >= config["mail"]["max_attempts"]:
+            outbox.fail(item["id"], error, item["attempts"])
+        else:
+            outbox.retry(item["id"], backoff(item["attempts"]), error)
+    return len(messages)
+
+
+def run(path=None, interval=60):
+    """
+    Sends queued messages forever. Sleeps until the next retry is due,
+    or until safe_send_mail queues something new.
+    """
+    if path is None:
+        path = config["mail"]["outbox"]
+    with Outbox(path) as outbox:
+        while True:
+            wake.clear()
+            try:
+                if drain(outbox):
+                    continue
+                delay = outbox.next_due()
+            except Exception as e:
+                logging.error(f"Mail sender: {e}")
+                delay = None
+            wake.wait(interval if delay is None else min(delay, interval))
+
+
+def start():
+    """
+    Starts this process's background sender, once.
+    """
+    global sender
+    with sender_lock:
+        if sender is None or not sender.is_alive():
+            sender = threading.Thread(target=run, name="mail-sender", daemon=True)
+            sender.start()
+
 
-    # encoded message
-    encoded_message = base64.urlsafe_b64encode(message.as_bytes()) \
-        .decode()
+def forget():
+    # threads do not survive a fork
+    global sender
+    sender = None
 
-    create_message = {
-        'raw': encoded_message
-    }
 
-    service.users().messages().send(
-        userId="me", 
-        body=create_message
-    ).execute()
+os.register_at_fork(after_in_child=forget)
 
 
 def safe_send_mail(body, to, subject="MultiEarth Eval Update"):
+    """
+    Queues a message in the outbox and returns; the background sender
+    delivers it, retrying with backoff. Messages left unsent when the
+    process exits are sent by the next sender to start.
+    """
     try:
-        send_mail(body, to, subject)
-    except:
-        logging.info("Unable to send mail.")
+        with Outbox(config["mail"]["outbox"]) as outbox:
+            outbox.put(to, subject, body)
+    except Exception as e:
+        logging.info(f"Unable to queue mail: {e}")
+        return
+    start()
+    wake.set()
 
 
 if __name__ == '__main__':
@@ -5,21 +5,25 @@ import time
 import sys
 
 # 3rd party
-from schedule import every, repeat, run_pending
 import lpips
-import cv2
-from skimage.metrics import structural_similarity as SSIM
 import torchvision.transforms as transforms
 import torch
 import PIL
 import numpy
-from pytorch_fid import fid_score
 import subprocess
 import rasterio
 import mail
 
 # custom
 from database import Database
+import jobs
+from config import config
+import fid_stats
+import lpips_cache
+import parallel
+import scoring
+import archive
+from checkpoint import Checkpoint
 
 # logging
 import logging
@@ -33,19 +37,22 @@ logging.basicConfig(
 toTensor = transforms.ToTensor()
 np = numpy
 
-# monkey patch
-from pytorch_fid.fid_score import ImagePathDataset
+# dtype chips are decoded to, see config["precision"]
+float_dtype = np.dtype(config["precision"]["dtype"])
 
-def monkey_patch_get_item(self, i):
-    path = self.files[i]
-    img = rasterio.open(path).read()[0]
-    img = norm_image(img).astype(numpy.float32)
-    img = numpy.dstack([img, img, img])
-    if self.transforms is not None:
-        img = self.transforms(img)
-    return img
+# torch setup
+if config["matrix_completion"]["torch_threads"]:
+    torch.set_num_threads(config["matrix_completion"]["torch_threads"])
 
-ImagePathDataset.__getitem__ = monkey_patch_get_item
+# lpips models, keyed by device, loaded once per process
+lpips_fns = {}
+
+
+def get_lpips_fn(gpu):
+    device = 'cuda' if gpu else 'cpu'
+    if device not in lpips_fns:
+        lpips_fns[device] = lpips.LPIPS(net='alex').to(device)
+    return lpips_fns[device]
 
 
 def get_averages(scores):
@@ -65,14 +72,15 @@ def get_averages(scores):
     scores["fid"] = sum(fid_scores) / len(fid_scores)
     return scores
 
-def norm_image(z):
+def norm_image(z, dtype=None):
+    dtype = float_dtype if dtype is None else np.dtype(dtype)
+    z = z.astype(dtype, copy=False)
     immax = np.max(z)
     immin = np.min(z)
     divisor = immax - immin
     if not divisor:
-        divisor = 1
+        divisor = dtype.type(1)
     norm_z = (z-immin)/(divisor)
-    norm_z = norm_z.astype(np.float64)
     return norm_z
 
 
@@ -87,113 +95,295 @@ def rasterio_to_tensor(img):
     tensor = torch.Tensor(stack)
     return tensor
 
-def eval_folder(truth_folder, submission_folder, lpips_fn, gpu):
+def eval_lpips_batch(lpips_fn, submission_tensors, truth_tensors, device, truth_lpips=None, files=None):
+    """
+    Takes in lists of (1, 3, H, W) tensors and returns one LPIPS score per pair.
+    With truth_lpips (lpips_cache.TruthFeatures) and the chip names in
+    files, the truth side is read from the cache instead of run through
+    AlexNet, or stored into it while the cache is being built.
+    """
+    with torch.inference_mode():
+        submission_batch = torch.cat(submission_tensors).to(device)
+        if truth_lpips is None:
+            truth_batch = torch.cat(truth_tensors).to(device)
+            distances = lpips_fn.forward(submission_batch, truth_batch)
+            return distances.flatten().tolist()
+        submission_layers = lpips_cache.layer_features(lpips_fn, submission_batch)
+        if truth_lpips.mode == 'r':
+            truth_layers = truth_lpips.get(files, device)
+        else:
+            truth_layers = lpips_cache.layer_features(lpips_fn, torch.cat(truth_tensors).to(device))
+            truth_lpips.put(files, truth_layers)
+        return lpips_cache.distances(lpips_fn, submission_layers, truth_layers)
+
+
+def load_chip(path, dtype=None):
+    """
+    Decodes and normalizes a single band chip.
+    """
+    with archive.open_raster(path) as src:
+        img = src.read(1)
+    return norm_image(img, dtype)
+
+
+def decode_chip(task):
+    """
+    Decodes one truth/submission pair, run inside the worker pool. Every
+    metric is computed on batches of these in the main process.
+    Inputs:
+        task: tuple; (chip, truth path, submission path)
+    Outputs:
+        result: tuple; (chip, truth image, submission image)
+    """
+    f, truth_path, submission_path = task
+    return f, load_chip(truth_path), load_chip(submission_path)
+
+
+def iter_chips(truth_folder, images, files=None, skip=(), decode_skipped=False, window=None, prefix=''):
+    """
+    Yields decode_chip results for every truth chip, in listing order,
+    decoding each file exactly once. Chips in skip are left out, unless
+    decode_skipped is set. Submitted chips are read from images, under
+    prefix.
+    """
+    if files is None:
+        files = os.listdir(truth_folder)
+    tasks = (
+        (f, os.path.join(truth_folder, f), images.path(prefix, f))
+        for f in files
+        if decode_skipped or f not in skip
+    )
+    yield from parallel.imap(decode_chip, tasks, window=window)
+
+
+def eval_folder(truth_folder, images, lpips_fn, gpu, batch_size=None, submission_features=None, truth_features=None, checkpoint=None, prefix='', truth_lpips=None):
+    """
+    Scores every chip in truth_folder against images/prefix. Each chip is
+    decoded once and the same arrays feed LPIPS, SSIM, PSNR and, when
+    Activations are passed in, the FID Inception features. Chips already in
+    checkpoint (keyed by prefix/chip), or whose content was scored before,
+    are not scored again; they are only decoded when their Inception
+    features are still needed. truth_lpips is the folder's cached truth
+    LPIPS features, or a cache being built by this pass.
+    """
     logging.info(f"Evaluating {truth_folder} folder")
-    scores = {}
-    lpips_scores = []
-    for f in os.listdir(truth_folder):
-        # truth
-        truth_path = os.path.join(truth_folder, f)
-        truth_im = rasterio.open(truth_path).read()[0]
-        truth_im = norm_image(truth_im)
-        truth_tensor = rasterio_to_tensor(truth_im)
-        if gpu:
-           truth_tensor.cuda()
-            # submission
-        submission_path = os.path.join(submission_folder, f)
-        submission_im = rasterio.open(submission_path).read()[0]
-        submission_im = norm_image(submission_im)
-        submission_tensor = rasterio_to_tensor(submission_im)
-        if gpu:
-            submission_tensor.cuda()
-            # scores
-        # debug
-        score_lpips = lpips_fn.forward(submission_tensor, truth_tensor)
-        score_lpips = score_lpips.item()
-        score_ssim = SSIM(submission_im, truth_im)
-
-        score_psnr = cv2.PSNR(truth_im, submission_im)
-        if numpy.isnan(score_psnr):
-            logging.error(truth_im)
-            logging.error(submission_im)
-        scores[f] = {
-                "lpips": score_lpips,
-                "ssim": score_ssim,
-                "psnr": score_psnr
-            }
-        lpips_scores.append(score_lpips)
+    if batch_size is None:
+        batch_size = config["matrix_completion"]["lpips_batch_size"]
+    device = 'cuda' if gpu else 'cpu'
+    files = os.listdir(truth_folder)
+    # keeps listing order in the output
+    scores = {f: None for f in files}
+    resumed = set()
+    if checkpoint is not None:
+        keys = [os.path.join(prefix, f) for f in files]
+        checkpoint.load_cached(keys)
+        for f, key in zip(files, keys):
+            cached = checkpoint.lookup(key)
+            if cached is not None:
+                scores[f] = cached
+                resumed.add(f)
+    need_features = submission_features is not None or truth_features is not None
+    # chips waiting for their batched SSIM / PSNR / LPIPS / Inception pass
+    batch = []
+
+    def flush():
+        new = [(f, truth_im, submission_im) for f, truth_im, submission_im in batch if f not in resumed]
+        if new:
+            truth_stack = np.stack([truth_im for _, truth_im, _ in new], dtype=float_dtype)
+            submission_stack = np.stack([submission_im for _, _, submission_im in new], dtype=float_dtype)
+            ssim_scores = scoring.ssim_batch(submission_stack, truth_stack, dtype=float_dtype)
+            psnr_scores = scoring.psnr_batch(truth_stack, submission_stack, dtype=float_dtype)
+            lpips_scores = eval_lpips_batch(
+                lpips_fn,
+                [rasterio_to_tensor(submission_im) for _, _, submission_im in new],
+                [rasterio_to_tensor(truth_im) for _, truth_im, _ in new],
+                device,
+                truth_lpips,
+                [f for f, _, _ in new]
+            )
+            for (f, truth_im, submission_im), score_ssim, score_psnr, score_lpips in zip(new, ssim_scores, psnr_scores, lpips_scores):
+                if numpy.isnan(score_psnr):
+                    logging.error(truth_im)
+                    logging.error(submission_im)
+                scores[f] = {
+                    "lpips": score_lpips,
+                    "ssim": float(score_ssim),
+                    "psnr": float(score_psnr)
+                }
+                if checkpoint is not None:
+                    checkpoint.add(os.path.join(prefix, f), scores[f])
+        # resumed chips still fill in a cache that is being built
+        old = [(f, truth_im) for f, truth_im, _ in batch if f in resumed]
+        if old and truth_lpips is not None and truth_lpips.mode == 'w+':
+            with torch.inference_mode():
+                truth_batch = torch.cat([rasterio_to_tensor(truth_im) for _, truth_im in old]).to(device)
+                truth_lpips.put([f for f, _ in old], lpips_cache.layer_features(lpips_fn, truth_batch))
+        if submission_features is not None:
+            submission_features.add([submission_im for _, _, submission_im in batch])
+        if truth_features is not None:
+            truth_features.add([truth_im for _, truth_im, _ in batch])
+        batch.clear()
+
+    chips = iter_chips(
+        truth_folder,
+        images,
+        files,
+        skip=resumed,
+        decode_skipped=need_features,
+        window=2 * batch_size,
+        prefix=prefix
+    )
+    for f, truth_im, submission_im in chips:
+        batch.append((f, truth_im, submission_im))
+        # every metric and inception, batched
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
     scores = get_averages(scores)
     return scores
 
-def evaluate(path):
+def evaluate(submission):
     """
     Actual implementation goes here.
-    PSNR -- cv2; 
+    PSNR -- scoring.psnr_batch, same formula as cv2
     LPIPS -- pip installed
-    SSIM -- scikit-image
+    SSIM -- scoring.ssim_batch, same window and constants as scikit-image
+    FID -- pytorch-fid's Inception, fed from the same decoded chips
     """
     gpu = torch.cuda.is_available()
     device = 'cuda' if gpu else 'cpu'
     truth_folder = "/app/truth/matrix-completion"
     # eval functions
-    lpips_fn = lpips.LPIPS(net='alex')
-    if gpu:
-        lpips_fn.cuda()
-    scores = {}
-    for folder in os.listdir(truth_folder):
-        mode_folder = os.path.join(truth_folder, folder)
-        if not os.path.isdir(mode_folder):
-            continue
-        submission_folder = os.path.join(path, folder)
-        results = eval_folder(mode_folder, submission_folder, lpips_fn, gpu)
-        # results = {"psnr": 360, "lpips": 0, "ssim": 1}
-        # TODO: Replace this hack with the actual Python function call
-        try:
-            fid = fid_score.calculate_fid_given_paths(
-                [mode_folder, submission_folder],
-                1,
-                device,
-                2048
-            )
-            fid = abs(fid)
-            if fid < 1e-5:
-                fid = 0
-            results["fid"] = fid
-        except Exception as e:
-            logging.error(e)
-            results["fid"] = 1
-        logging.info(f"FID: {results['fid']}")
-        #results["fid"] = float(subprocess.check_output(f"python3 -m pytorch_fid --num-workers 1 {submission_folder} {mode_folder}", shell=True).replace('FID: ', '').replace("\n", '')) # fid_score.calculate_fid_given_paths([submission_folder, truth_folder], 1, device, 2048, 2)
-        scores[folder] = results
+    lpips_fn = get_lpips_fn(gpu)
+    fid_model = fid_stats.get_model(2048, device)
+    # chip scores are written in batches, so a restart resumes mid-submission
+    checkpoint = Checkpoint.for_folder("matrix_completion", submission, truth=truth_folder)
+    # extracted images, or the kept zip read without extracting
+    with archive.Images(submission) as images:
+        scores = {}
+        for folder in os.listdir(truth_folder):
+            mode_folder = os.path.join(truth_folder, folder)
+            if not os.path.isdir(mode_folder):
+                continue
+            # truth side statistics are cached per dataset folder
+            truth_stats = fid_stats.cached_truth_statistics(mode_folder, 2048)
+            submission_features = fid_stats.Activations(fid_model, device)
+            truth_features = None if truth_stats else fid_stats.Activations(fid_model, device)
+            # and so are the truth side LPIPS features, built on first use
+            truth_lpips = lpips_cache.load(mode_folder)
+            lpips_builder = None
+            if truth_lpips is None:
+                lpips_builder = truth_lpips = lpips_cache.builder(mode_folder, os.listdir(mode_folder))
+            try:
+                results = eval_folder(
+                    mode_folder,
+                    images,
+                    lpips_fn,
+                    gpu,
+                    submission_features=submission_features,
+                    truth_features=truth_features,
+                    checkpoint=checkpoint,
+                    prefix=folder,
+                    truth_lpips=truth_lpips
+                )
+            except Exception:
+                # a half built cache holds full size memmaps, never leave it behind
+                if lpips_builder is not None:
+                    lpips_cache.discard(lpips_builder)
+                raise
+            if lpips_builder is not None:
+                lpips_cache.save(mode_folder, lpips_builder)
+            # results = {"psnr": 360, "lpips": 0, "ssim": 1}
+            try:
+                if truth_stats is None:
+                    truth_stats = truth_features.statistics()
+                    fid_stats.save_truth_statistics(mode_folder, *truth_stats, 2048)
+                fid = fid_stats.frechet_distance(truth_stats, submission_features.statistics())
+                fid = abs(fid)
+                if fid < 1e-5:
+                    fid = 0
+                results["fid"] = fid
+            except Exception as e:
+                logging.error(e)
+                results["fid"] = 1
+            logging.info(f"FID: {results['fid']}")
+            scores[folder] = results
+        checkpoint.flush()
     scores = get_averages(scores)
     return scores
    
 
+def eval_submission(submission_path, team):
+    """
+    Scores one submission folder and emails the results.
+    Inputs:
+        submission_path: String; path of the submission folder
+        team: String; team name, used for logging
+    Outputs:
+        results: dictionary or None; scores, None if already evaluated
+    """
+    meta_path = os.path.join(submission_path, "metadata.json")
+    with open(meta_path) as incoming:
+        metadata = json.load(incoming)
+    if metadata["evaluated"]:
+        return None
+    logging.info(f"New submission for team: {team}; folder: {submission_path}")
+    results = evaluate(submission_path)
+    logging.info(f"Scores: LPIPS: {results['lpips']} SSIM: {results['ssim']} PSNR: {results['psnr']} FID: {results['fid']}")
+    metadata["evaluated"] = True
+    metadata.update(**results)
+    with open(meta_path, 'w') as output:
+        content = json.dumps(metadata, indent=2)
+        output.write(content)
+    metadata.pop('prediction', None)
+    mail.safe_send_mail(json.dumps(metadata, indent=2), metadata["emails"])
+    return results
+
+
 def eval_team(team_path, team):
     scores = []
     items = [os.path.join(team_path, item) for item in os.listdir(team_path)]
     folders = [f for f in items if os.path.isdir(f)]
     for folder in folders:
-        meta_path = os.path.join(team_path, folder, "metadata.json")
-        image_path = os.path.join(team_path, folder, "images")
-        with open(meta_path) as incoming:
-            metadata = json.load(incoming)
-        if metadata["evaluated"]:
+        # a broken submission must not keep the rest of the team from being scored
+        try:
+            results = eval_submission(folder, team)
+        except Exception as e:
+            logging.error(f"{folder}: {e}")
             continue
-        logging.info(f"New submission for team: {team}; folder: {folder}")
-        results = evaluate(image_path)
-        logging.info(f"Scores: LPIPS: {results['lpips']} SSIM: {results['ssim']} PSNR: {results['psnr']} FID: {results['fid']}")
-        metadata["evaluated"] = True
-        metadata.update(**results)
-        with open(meta_path, 'w') as output:
-            content = json.dumps(metadata, indent=2)
-            output.write(content)
-        scores.append(results)
-        del metadata['prediction']
-        mail.safe_send_mail(json.dumps(metadata, indent=2), metadata["emails"])
+        if results:
+            scores.append(results)
     return scores
-        
-@repeat(every(60).seconds)
+
+
+def update_best(team, scores):
+    """
+    Puts the lowest LPIPS of scores on the leaderboard if it beats the team's best.
+    """
+    if not scores:
+        return
+    low_score = scores[0]
+    for score in scores:
+        if score["lpips"] < low_score["lpips"]:
+            low_score = score
+    best_score = low_score["lpips"]
+    with Database("db/db.sqlite3") as db:
+        logging.info(team)
+        previous_best = db.get_completion_score_by_team(team)
+        logging.info(f"Previous Best: {previous_best} This Best: {best_score}")
+        if best_score < previous_best:
+            db.update_leaderboard(
+                "UPDATE MatrixCompletionScores SET lpips = ?, psnr = ?, ssim = ?, fid = ? WHERE team = ?",
+                (best_score, low_score['psnr'], low_score['ssim'], low_score['fid'], team)
+            )
+
+
+def update_team(folder, team):
+    logging.info(f"Evaluating team: {team}")
+    update_best(team, eval_team(folder, team))
+
+
 def main(path="/app/submissions/valid/matrix_completion"):
     os.makedirs(path, exist_ok=True)
     logging.info("Starting scan")
@@ -201,25 +391,19 @@ def main(path="/app/submissions/valid/matrix_completion"):
     folders = [f for f in items if os.path.isdir(f)]
     for folder in folders:
         team = os.path.split(folder)[1]
-        logging.info(f"Evaluating team: {team}")
-        scores = eval_team(folder, team)
-        if not scores:
-            continue
-        low_score = scores[0]
-        for score in scores:
-            if score["lpips"] < low_score["lpips"]:
-                low_score = score
-        best_score = low_score["lpips"]
-        with Database("db/db.sqlite3") as db:
-            logging.info(team)
-            previous_best = db.get_completion_score_by_team(team)
-            logging.info(f"Previous Best: {previous_best} This Best: {best_score}")
-            if best_score < previous_best:
-                db.query(f"UPDATE MatrixCompletionScores SET lpips = {best_score}, psnr = {low_score['psnr']}, ssim = {low_score['ssim']}, fid = {low_score['fid']} WHERE team = '{team}'")
+        update_team(folder, team)
     logging.info("Done with scan")
 
 
+def handle_job(job, path="/app/submissions/valid/matrix_completion"):
+    # only the queued submission; failures are left to jobs.serve
+    team = job["team"]
+    results = eval_submission(os.path.join(path, team, job["submission"]), team)
+    if results:
+        update_best(team, [results])
+
+
 if __name__ == '__main__':
-    while True:
-        run_pending()
-        time.sleep(1)
+    # pick up anything saved while no evaluator was running
+    main()
+    jobs.serve("matrix_completion", handle_job)
@@ -0,0 +1,161 @@
+# built in
+import sqlite3
+import datetime
+import json
+import time
+import os
+
+# custom
+import connections
+
+# logging
+import logging
+
+
+class Outbox:
+    """
+    Durable queue of result emails. Evaluators put messages and carry on;
+    a background sender claims them in batches and marks each one sent, or
+    schedules a retry. A claimed message is leased until next_attempt, so
+    one left behind by a crashed sender is picked up again later.
+    """
+    def __init__(self, path):
+        # path to file
+        self.path = path
+
+        # whether we're connected or not
+        self.connection = None
+
+        # create the table if none exists
+        self.__enter__()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS Messages
+            (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipients TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                error TEXT,
+                created TEXT NOT NULL,
+                updated TEXT
+            );
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS MessagesByStatus ON Messages (status, next_attempt);"
+        )
+        self.__exit__(None, None, None)
+
+    def __enter__(self):
+        """
+        Enables the "with X as Y:" syntax
+        """
+        if not self.connection:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # autocommit, transactions are opened explicitly where needed
+            self.connection = sqlite3.connect(self.path, timeout=connections.busy_timeout, isolation_level=None)
+            connections.configure(self.connection)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Defines what to do when "with X as Y:" closes
+        """
+        if not self.connection:
+            return
+        else:
+            self.connection.close()
+            self.connection = None
+
+    def put(self, recipients, subject, body):
+        """
+        Queues a message for the sender.
+        Inputs:
+            recipients: String or list; email addresses
+            subject: String; subject line
+            body: String; plain text body
+        Outputs:
+            id: int; message id
+        """
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        now = datetime.datetime.now().isoformat()
+        cursor = self.connection.execute(
+            "INSERT INTO Messages (recipients, subject, body, next_attempt, created) VALUES (?, ?, ?, ?, ?);",
+            (json.dumps(list(recipients)), subject, body, time.time(), now)
+        )
+        return cursor.lastrowid
+
+    def claim(self, limit, lease):
+        """
+        Leases up to limit pending messages whose next attempt is due.
+        Inputs:
+            limit: int; batch size
+            lease: float; seconds before an unfinished claim is retried
+        Outputs:
+            messages: list; dictionaries of id, recipients, subject, body and attempts
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE;")
+        try:
+            rows = self.connection.execute(
+                "SELECT id, recipients, subject, body, attempts FROM Messages WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?;",
+                (now, limit)
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE Messages SET attempts = attempts + 1, next_attempt = ? WHERE id = ?;",
+                [(now + lease, row[0]) for row in rows]
+            )
+            self.connection.execute("COMMIT;")
+        except Exception:
+            self.connection.execute("ROLLBACK;")
+            raise
+        return [
+            {
+                "id": row[0],
+                "recipients": json.loads(row[1]),
+                "subject": row[2],
+                "body": row[3],
+                "attempts": row[4] + 1
+            }
+            for row in rows
+        ]
+
+    def sent(self, message_id):
+        self.set_status(message_id, 'sent')
+
+    def retry(self, message_id, delay, error):
+        now = datetime.datetime.now().isoformat()
+        self.connection.execute(
+            "UPDATE Messages SET next_attempt = ?, error = ?, updated = ? WHERE id = ?;",
+            (time.time() + delay, str(error), now, message_id)
+        )
+        logging.info(f"Unable to send mail {message_id}, retrying in {delay}s: {error}")
+
+    def fail(self, message_id, error, attempts):
+        self.set_status(message_id, 'failed', error)
+        logging.error(f"Unable to send mail {message_id} after {attempts} attempts: {error}")
+
+    def set_status(self, message_id, status, error=None):
+        now = datetime.datetime.now().isoformat()
+        self.connection.execute(
+            "UPDATE Messages SET status = ?, error = ?, updated = ? WHERE id = ?;",
+            (status, None if error is None else str(error), now, message_id)
+        )
+
+    def next_due(self):
+        """
+        Seconds until the next pending message is due, None if there is none.
+        """
+        row = self.connection.execute(
+            "SELECT MIN(next_attempt) FROM Messages WHERE status = 'pending';"
+        ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
@@ -0,0 +1,79 @@
+# built in
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+import os
+
+# custom
+from config import config
+
+# logging
+import logging
+
+# worker pools, keyed by worker count, shared by every evaluator in a process
+pools = {}
+
+
+def get_workers(workers=None):
+    if workers is None:
+        workers = config["parallel"]["workers"]
+    return max(1, workers or os.cpu_count() or 1)
+
+
+def get_pool(workers):
+    """
+    Returns the process pool with this many workers, creating it on first use.
+    """
+    if workers not in pools:
+        logging.info(f"Starting pool with {workers} workers")
+        pools[workers] = ProcessPoolExecutor(workers)
+    return pools[workers]
+
+
+def shutdown():
+    for pool in pools.values():
+        pool.shutdown()
+    pools.clear()
+
+
+def imap(fn, items, workers=None, window=None):
+    """
+    Applies fn to every item across a process pool, yielding results in the
+    same order as items. At most window tasks are in flight, so results that
+    hold large arrays never pile up in memory.
+    Inputs:
+        fn: function; module level so it can be pickled
+        items: iterable; arguments, one per call
+        workers: int; pool size, defaults to config["parallel"]["workers"]
+        window: int; tasks in flight, defaults to 4 per worker
+    Outputs:
+        results: generator; fn(item) for each item, in order
+    """
+    workers = get_workers(workers)
+    if workers == 1:
+        yield from map(fn, items)
+        return
+    pool = get_pool(workers)
+    window = max(window or workers * 4, workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        # a dead worker poisons the pool, start a fresh one next time
+        pools.pop(workers, None)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def map_chips(fn, items, workers=None):
+    """
+    Same as imap, but returns a list.
+    """
+    return list(imap(fn, items, workers))
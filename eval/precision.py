@@ -0,0 +1,177 @@
+# built in
+import json
+import os
+import sys
+
+# 3rd party
+import numpy as np
+import cv2
+from skimage.metrics import structural_similarity as SSIM
+
+# custom
+import archive
+import fid_stats
+import matrix
+import scoring
+import translation
+
+# logging
+import logging
+
+# largest allowed change of a leaderboard score between the float64
+# reference pipeline and the float32 one
+epsilons = {
+    "ssim": 1e-4,
+    "psnr": 1e-3,
+    "lpips": 1e-4,
+    "mse": 1e-6,
+    "fid": 1e-3,
+}
+
+
+def summarize(reference, fast):
+    """
+    Takes in per chip scores of both pipelines and returns, per metric, the
+    largest per chip difference and the difference of the averages, which
+    is what reaches the leaderboard.
+    """
+    output = {}
+    for metric in reference:
+        ref = np.asarray(reference[metric], dtype=np.float64)
+        new = np.asarray(fast[metric], dtype=np.float64)
+        mean_diff = abs(float(ref.mean() - new.mean())) if len(ref) else 0.0
+        output[metric] = {
+            "chips": len(ref),
+            "max_chip_diff": float(np.abs(ref - new).max()) if len(ref) else 0.0,
+            "mean_diff": mean_diff,
+            "epsilon": epsilons[metric],
+            "ok": mean_diff <= epsilons[metric]
+        }
+    return output
+
+
+def compare_matrix(truth_folder, submission_folder, limit=None, gpu=False):
+    """
+    Scores matrix completion chips the previous way (float64 decode,
+    skimage SSIM, cv2 PSNR) and the current way (float32 decode, batched
+    kernels) and compares them. LPIPS and FID are run on both decodes.
+    Inputs:
+        truth_folder: String; one dataset folder of truth chips
+        submission_folder: String; the matching submitted chips
+        limit: int; number of chips to check, all when None
+    Outputs:
+        report: dictionary; see summarize
+    """
+    files = sorted(os.listdir(truth_folder))[:limit]
+    lpips_fn = matrix.get_lpips_fn(gpu)
+    device = 'cuda' if gpu else 'cpu'
+    fid_model = fid_stats.get_model(2048, device)
+    reference = {"ssim": [], "psnr": [], "lpips": []}
+    fast = {"ssim": [], "psnr": [], "lpips": []}
+    # Inception activations of each decode, truth and submission
+    activations = {
+        dtype: (fid_stats.Activations(fid_model, device), fid_stats.Activations(fid_model, device))
+        for dtype in (np.float64, np.float32)
+    }
+    for start in range(0, len(files), 32):
+        batch = files[start:start + 32]
+        decoded = {}
+        for dtype in (np.float64, np.float32):
+            decoded[dtype] = (
+                [matrix.load_chip(os.path.join(truth_folder, f), dtype) for f in batch],
+                [matrix.load_chip(os.path.join(submission_folder, f), dtype) for f in batch]
+            )
+            activations[dtype][0].add(decoded[dtype][0])
+            activations[dtype][1].add(decoded[dtype][1])
+        truths, submissions = decoded[np.float64]
+        for truth_im, submission_im in zip(truths, submissions):
+            # skimage 0.17 takes the float dtype range, 2, by default
+            reference["ssim"].append(SSIM(submission_im, truth_im, data_range=2))
+            reference["psnr"].append(cv2.PSNR(truth_im, submission_im))
+        reference["lpips"].extend(matrix.eval_lpips_batch(
+            lpips_fn,
+            [matrix.rasterio_to_tensor(im) for im in submissions],
+            [matrix.rasterio_to_tensor(im) for im in truths],
+            device
+        ))
+        truths, submissions = decoded[np.float32]
+        fast["ssim"].extend(scoring.ssim_batch(np.stack(submissions), np.stack(truths)))
+        fast["psnr"].extend(scoring.psnr_batch(np.stack(truths), np.stack(submissions)))
+        fast["lpips"].extend(matrix.eval_lpips_batch(
+            lpips_fn,
+            [matrix.rasterio_to_tensor(im) for im in submissions],
+            [matrix.rasterio_to_tensor(im) for im in truths],
+            device
+        ))
+    for dtype, output in ((np.float64, reference), (np.float32, fast)):
+        truth_features, submission_features = activations[dtype]
+        output["fid"] = [abs(fid_stats.frechet_distance(truth_features.statistics(), submission_features.statistics()))]
+    return summarize(reference, fast)
+
+
+def compare_translation(submission_files, truth_files, tiff_dir):
+    """
+    Compares the translation MSE matrix of float64 and float32 decodes.
+    Inputs:
+        submission_files: list; paths of submitted RGB tiffs
+        truth_files: list; truth file names in tiff_dir
+        tiff_dir: String; folder of single band truth tiffs
+    Outputs:
+        report: dictionary; see summarize
+    """
+    reference = {"mse": translation_errors(submission_files, truth_files, tiff_dir, np.float64)}
+    fast = {"mse": translation_errors(submission_files, truth_files, tiff_dir, np.float32)}
+    return summarize(reference, fast)
+
+
+def translation_errors(submission_files, truth_files, tiff_dir, dtype):
+    # every pair MSE of one mapping, decoded in dtype
+    submissions = np.stack([translation.load_image(f, dtype) for f in submission_files])
+    truths = np.stack([translation.create_rgb_image(f, tiff_dir, dtype) for f in truth_files])
+    errors, best = translation.mse_matrix(submissions, truths, dtype)
+    return list(errors.reshape(-1))
+
+
+def compare_translation_submission(submission, truth="/app/truth/translation"):
+    """
+    Runs compare_translation over every mapping in truth's files.json.
+    Inputs:
+        submission: String; submission folder, extracted or zip-only
+        truth: String; translation truth folder
+    Outputs:
+        report: dictionary; see summarize
+    """
+    with open(os.path.join(truth, 'files.json')) as incoming:
+        inputs = json.load(incoming)
+    tiff_dir = os.path.join(truth, 'translation')
+    reference = {"mse": []}
+    fast = {"mse": []}
+    with archive.Images(submission) as images:
+        for input_f, mapping in inputs.items():
+            submission_files = [images.path('translation', f) for f in eval(input_f)]
+            reference["mse"].extend(translation_errors(submission_files, mapping, tiff_dir, np.float64))
+            fast["mse"].extend(translation_errors(submission_files, mapping, tiff_dir, np.float32))
+    return summarize(reference, fast)
+
+
+def validate(report):
+    """
+    Logs a comparison report and returns whether every metric is in bounds.
+    """
+    ok = True
+    for metric, result in report.items():
+        logging.info(f"{metric}: {result}")
+        ok = ok and result["ok"]
+    return ok
+
+
+if __name__ == '__main__':
+    # python precision.py <truth dataset folder> <submission dataset folder> [chips]
+    # python precision.py translation <submission folder> [truth folder]
+    if sys.argv[1] == 'translation':
+        report = compare_translation_submission(*sys.argv[2:4])
+    else:
+        limit = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        report = compare_matrix(sys.argv[1], sys.argv[2], limit)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if validate(report) else 1)
@@ -0,0 +1,181 @@
+# built in
+
+# 3rd party
+import numpy as np
+from scipy.ndimage import uniform_filter1d
+
+# logging
+import logging
+
+
+def binarize(band, threshold=0):
+    """
+    Takes in a single band and returns a boolean mask of pixels above threshold.
+    Inputs:
+        band: numpy array; band as returned by rasterio
+        threshold: number; pixels strictly greater than this are positive
+    Outputs:
+        mask: numpy array; boolean mask, same shape as band
+    """
+    return np.greater(band, threshold)
+
+
+def pack_mask(mask):
+    """
+    Takes in a binary mask and returns it bit-packed, 8 pixels per byte.
+    """
+    return np.packbits(np.asarray(mask, dtype=bool).reshape(-1))
+
+
+def unpack_mask(bits, shape):
+    """
+    Takes in a bit-packed mask and its shape and returns the boolean mask.
+    """
+    count = int(np.prod(shape))
+    return np.unpackbits(bits, count=count).view(bool).reshape(shape)
+
+
+def _as_bool(mask):
+    # 0/1 uint8 bands can be reinterpreted in place instead of copied
+    if mask.dtype == np.uint8:
+        return mask.view(bool)
+    return mask.astype(bool, copy=False)
+
+
+def confusion_matrix(truth, submission, chip=""):
+    """
+    Takes in two binary masks and returns the 2x2 confusion matrix.
+    Inputs:
+        truth: array-like; boolean or binary (0/1) truth mask
+        submission: array-like; boolean or binary (0/1) submitted mask
+        chip: String; chip name, used for logging
+    Outputs:
+        matrix: numpy array; [[tn, fp], [fn, tp]] as int64
+    """
+    truth = np.asarray(truth)
+    submission = np.asarray(submission)
+    if truth.size != submission.size:
+        logging.error(f"{chip}: truth has {truth.size} pixels, submission has {submission.size}")
+        raise ValueError(f"Shape mismatch for {chip}")
+    # f1 only makes sense for binary labels, same as sklearn's pos_label=1
+    for mask in (truth, submission):
+        if mask.dtype != bool and mask.size and mask.max() > 1:
+            logging.error(np.unique(truth))
+            logging.error(np.unique(submission))
+            logging.error(chip)
+            raise ValueError(f"Non-binary mask for {chip}")
+    truth = _as_bool(truth.reshape(-1))
+    submission = _as_bool(submission.reshape(-1))
+    tp = np.count_nonzero(truth & submission)
+    fn = np.count_nonzero(truth) - tp
+    fp = np.count_nonzero(submission) - tp
+    tn = truth.size - tp - fn - fp
+    matrix = np.array([[tn, fp], [fn, tp]], dtype=np.int64)
+    return matrix
+
+
+def scores_from_matrix(matrix):
+    """
+    Takes in a 2x2 confusion matrix and returns accuracy, F1 and IoU.
+    Matches the previous per-pixel / sklearn implementations:
+        accuracy is a percentage of matching pixels
+        f1 is 1 when there are no positives at all (zero_division=1)
+        iou is 1 when the union is empty
+    Inputs:
+        matrix: numpy array; [[tn, fp], [fn, tp]]
+    Outputs:
+        scores: dictionary; accuracy, f1 and iou
+    """
+    (tn, fp), (fn, tp) = matrix.tolist()
+    total = tn + fp + fn + tp
+    accuracy = (tn + tp) / total * 100 if total else 0
+    errors = fp + fn
+    union = tp + errors
+    f1 = 2 * tp / (2 * tp + errors) if union else 1.0
+    iou = tp / union if union else 1
+    return {
+        "accuracy": accuracy,
+        "f1": f1,
+        "iou": iou
+    }
+
+
+def get_scores(truth, submission, chip=""):
+    """
+    Takes in two binary masks and returns accuracy, F1 and IoU computed
+    from a single shared confusion matrix.
+    Inputs:
+        truth: array-like; binary (0/1) truth mask, e.g. a rasterio band
+        submission: array-like; binary (0/1) submitted mask
+        chip: String; chip name, used for logging
+    Outputs:
+        scores: dictionary; accuracy, f1 and iou
+    """
+    matrix = confusion_matrix(truth, submission, chip)
+    return scores_from_matrix(matrix)
+
+
+def _box_filter(images, size):
+    # separable mean filter over the last two axes, reflect padding like skimage
+    images = uniform_filter1d(images, size, axis=-1, mode='reflect')
+    return uniform_filter1d(images, size, axis=-2, mode='reflect')
+
+
+def ssim_batch(submissions, truths, data_range=2.0, win_size=7, K1=0.01, K2=0.03, dtype=np.float32):
+    """
+    Takes in two stacks of single band images and returns the mean SSIM of
+    every pair, computed for the whole stack at once in dtype.
+    Matches skimage.metrics.structural_similarity(submission, truth) as
+    called on float images by scikit-image 0.17: a 7x7 uniform window,
+    sample covariance, data_range 2 (the float dtype range) and the mean
+    taken away from the padded border. Agrees with it to within 1e-4
+    absolute for images normalized to [0, 1].
+    Inputs:
+        submissions: array-like; (B, H, W) submitted images
+        truths: array-like; (B, H, W) truth images
+        dtype: numpy dtype; float32, or float64 for full precision
+    Outputs:
+        ssim: numpy array; (B,) float64 mean SSIM per pair
+    """
+    x = np.asarray(submissions, dtype=dtype)
+    y = np.asarray(truths, dtype=dtype)
+    if x.shape != y.shape:
+        raise ValueError(f"Shape mismatch: {x.shape} and {y.shape}")
+    count = win_size * win_size
+    cov_norm = count / (count - 1)
+    ux = _box_filter(x, win_size)
+    uy = _box_filter(y, win_size)
+    uxx = _box_filter(x * x, win_size)
+    uyy = _box_filter(y * y, win_size)
+    uxy = _box_filter(x * y, win_size)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux * ux + uy * uy + C1) * (vx + vy + C2))
+    pad = (win_size - 1) // 2
+    return S[:, pad:-pad, pad:-pad].mean(axis=(1, 2), dtype=np.float64)
+
+
+def psnr_batch(truths, submissions, R=255.0, dtype=np.float32):
+    """
+    Takes in two stacks of images and returns the PSNR of every pair, the
+    same way as cv2.PSNR(truth, submission): 20 * log10(R / (rmse + eps)),
+    so identical images score about 361 rather than infinity. The squared
+    error is accumulated in float64 and agrees with cv2 to within 1e-4 dB.
+    Inputs:
+        truths: array-like; (B, ...) truth images
+        submissions: array-like; (B, ...) submitted images
+        R: float; peak value, cv2's default of 255
+        dtype: numpy dtype; float32, or float64 for full precision
+    Outputs:
+        psnr: numpy array; (B,) float64 PSNR per pair
+    """
+    truths = np.asarray(truths, dtype=dtype)
+    submissions = np.asarray(submissions, dtype=dtype)
+    if truths.shape != submissions.shape:
+        raise ValueError(f"Shape mismatch: {truths.shape} and {submissions.shape}")
+    diff = (truths - submissions).reshape(len(truths), -1)
+    mse = np.einsum('ij,ij->i', diff, diff, dtype=np.float64) / diff.shape[1]
+    return 20 * np.log10(R / (np.sqrt(mse) + np.finfo(np.float64).eps))
@@ -2,16 +2,20 @@
 import json
 import os
 import time
+from functools import partial
 
 # 3rd party
 import rasterio
-from sklearn.metrics import mean_squared_error as MSE
 import numpy as np
 from PIL import Image
-from schedule import every, repeat, run_pending
 
 # custom
+from config import config
 from database import Database
+import jobs
+import parallel
+import archive
+from checkpoint import Checkpoint
 
 # logging
 import logging
@@ -22,36 +26,42 @@ logging.basicConfig(
     datefmt="%Y-%m-%dT%H:%M:%S%z"
 )
 
+# dtype images are decoded to, see config["precision"]
+float_dtype = np.dtype(config["precision"]["dtype"])
+
+
 def avg(x):
     if not x:
         return 1000
     return sum(x) / len(x)
 
-def norm_image(z):
+def norm_image(z, dtype=None):
+    dtype = float_dtype if dtype is None else np.dtype(dtype)
+    z = z.astype(dtype, copy=False)
     immax = np.max(z)
     immin = np.min(z)
     divisor = immax - immin
     if not divisor:
-        divisor = 1.0
+        divisor = dtype.type(1)
     norm_z = (z-immin)/(divisor)
-    norm_z = norm_z.astype(np.float64)
     return norm_z
 
 
-def load_image(path):
-    img = rasterio.open(path).read()
+def load_image(path, dtype=None):
+    with archive.open_raster(path) as src:
+        img = src.read()
     if img.shape[2] == 3:
         img = img.transpose(2, 0, 1)
     elif img.shape[0] != 3:
         logging.error(f"Shape is {img.shape}")
-    multi_rgb = np.zeros((3,256,256))
-    multi_rgb[0,:,:] = norm_image(img[0])
-    multi_rgb[1,:,:] = norm_image(img[1])
-    multi_rgb[2,:,:] = norm_image(img[2])
+    multi_rgb = np.zeros((3,256,256), dtype=float_dtype if dtype is None else dtype)
+    multi_rgb[0,:,:] = norm_image(img[0], dtype)
+    multi_rgb[1,:,:] = norm_image(img[1], dtype)
+    multi_rgb[2,:,:] = norm_image(img[2], dtype)
     return multi_rgb
 
 
-def create_rgb_image(filename, tiff_dir):
+def create_rgb_image(filename, tiff_dir, dtype=None):
     """
     Thanks to Gregory Angelides
     Given a filename of the format Sentinel-1_lon_lat_date.tiff will
@@ -60,31 +70,136 @@ def create_rgb_image(filename, tiff_dir):
     """
     filename_parts = filename.split("_")
     img_b2 = np.array(rasterio.open(f"{tiff_dir}/{filename_parts[0]}_B2_{'_'.join(filename_parts[1:])}").read()[0])
-    img_b2 = norm_image(img_b2)
+    img_b2 = norm_image(img_b2, dtype)
     img_b3 = np.array(rasterio.open(f"{tiff_dir}/{filename_parts[0]}_B3_{'_'.join(filename_parts[1:])}").read()[0])
-    img_b3 = norm_image(img_b3)
+    img_b3 = norm_image(img_b3, dtype)
     img_b4 = np.array(rasterio.open(f"{tiff_dir}/{filename_parts[0]}_B4_{'_'.join(filename_parts[1:])}").read()[0])
-    img_b4 = norm_image(img_b4)
+    img_b4 = norm_image(img_b4, dtype)
     output = np.stack((img_b4, img_b3, img_b2))
     return output
 
 
-def eval_mapping(obj, submission_files, truth="/app/truth/translation/translation"):
+class TruthStack:
+    """
+    Normalized truth RGB images for one tiff folder, decoded once per process
+    and kept in a single (N, 3, H, W) array of the precision dtype.
+    """
+    def __init__(self, tiff_dir, dtype=None):
+        self.tiff_dir = tiff_dir
+        self.dtype = float_dtype if dtype is None else np.dtype(dtype)
+        self.index = {}
+        self.images = None
+
+    def load(self, filenames):
+        """
+        Decodes every filename not already in the stack.
+        """
+        new = [f for f in dict.fromkeys(filenames) if f not in self.index]
+        if not new:
+            return
+        decoded = parallel.map_chips(partial(create_rgb_image, tiff_dir=self.tiff_dir, dtype=self.dtype), new)
+        decoded = np.stack(decoded, dtype=self.dtype)
+        offset = 0 if self.images is None else len(self.images)
+        for i, filename in enumerate(new):
+            self.index[filename] = offset + i
+        if self.images is None:
+            self.images = decoded
+        else:
+            self.images = np.concatenate((self.images, decoded))
+
+    def get(self, filename):
+        self.load([filename])
+        return self.images[self.index[filename]]
+
+    def stack(self, filenames):
+        """
+        Returns the (len(filenames), 3, H, W) stack for filenames, in order.
+        """
+        self.load(filenames)
+        return self.images[[self.index[f] for f in filenames]]
+
+
+# truth stacks, keyed by tiff folder
+truth_stacks = {}
+
+
+def get_truth_stack(tiff_dir):
+    if tiff_dir not in truth_stacks:
+        truth_stacks[tiff_dir] = TruthStack(tiff_dir)
+    return truth_stacks[tiff_dir]
+
+
+def mse_matrix(submissions, truths, dtype=None):
+    """
+    Takes in a stack of submission images and a stack of truth images and
+    returns the MSE of every (submission, truth) pair. Truths are taken
+    one at a time against the whole submission stack, so only one
+    (S, pixels) scratch array is alive at once.
+    Differences are taken in the precision dtype, the mean is always
+    accumulated in float64.
+    Inputs:
+        submissions: numpy array; (S, ...) submission images
+        truths: numpy array; (T, ...) truth images, same shape per image
+    Outputs:
+        errors: numpy array; (S, T) float64 MSE matrix
+        best: numpy array; (S,) minimum MSE per submission
+    """
+    dtype = float_dtype if dtype is None else np.dtype(dtype)
+    submissions = np.asarray(submissions, dtype=dtype).reshape(len(submissions), -1)
+    truths = np.asarray(truths, dtype=dtype).reshape(len(truths), -1)
+    errors = np.empty((len(submissions), len(truths)), dtype=np.float64)
+    scratch = np.empty_like(submissions)
+    for j, truth in enumerate(truths):
+        np.subtract(truth, submissions, out=scratch)
+        np.square(scratch, out=scratch)
+        scratch.mean(axis=1, dtype=np.float64, out=errors[:, j])
+    best = errors.min(axis=1)
+    return errors, best
+
+
+def pair_key(submission_path, truth_path):
+    return f"{os.path.basename(submission_path)} -> {truth_path}"
+
+
+def pair_path(submission_path):
+    # submitted file relative to images/, as hashed by the frontend
+    return os.path.join('translation', os.path.basename(submission_path))
+
+
+def eval_mapping(obj, submission_files, truth="/app/truth/translation/translation", checkpoint=None):
     output = {}
     values = []
-    for submission_path in submission_files:
-        MSEs = []
+    # mappings finished by an interrupted run, or whose submitted files
+    # were scored before, are not decoded again
+    resumed = False
+    if checkpoint is not None:
+        pairs = [
+            (pair_key(submission_path, truth_path), pair_path(submission_path))
+            for submission_path in submission_files
+            for truth_path in obj
+        ]
+        checkpoint.load_cached([key for key, _ in pairs], [path for _, path in pairs])
+        resumed = all(checkpoint.lookup(key) is not None for key, _ in pairs)
+    if submission_files and resumed:
+        errors = np.array([
+            [checkpoint.get(pair_key(submission_path, truth_path))["mse"] for truth_path in obj]
+            for submission_path in submission_files
+        ])
+        best = errors.min(axis=1)
+    elif submission_files:
+        submission_imgs = np.stack(parallel.map_chips(load_image, submission_files))
+        truth_imgs = get_truth_stack(truth).stack(obj)
+        errors, best = mse_matrix(submission_imgs, truth_imgs)
+    for i, submission_path in enumerate(submission_files):
         output[submission_path] = {}
-        submission_img = load_image(submission_path)
-        for truth_path in obj:
-            truth_img = create_rgb_image(truth_path, truth)
-            mse = MSE(truth_img.flatten(), submission_img.flatten())
-            MSEs.append(mse)
+        for j, truth_path in enumerate(obj):
+            mse = float(errors[i, j])
             output[submission_path][truth_path] = mse
+            if checkpoint is not None and not resumed:
+                checkpoint.add(pair_key(submission_path, truth_path), {"mse": mse}, pair_path(submission_path))
             logging.info(f"{truth_path.replace('.tiff', '')} -> {submission_path.replace('.tiff', '')} = {mse}")
-        best = min(MSEs)
-        output[submission_path]["min"] = best
-        values.append(best)
+        output[submission_path]["min"] = float(best[i])
+        values.append(float(best[i]))
     output["sum"] = sum(values)
     return output
 
@@ -94,59 +209,91 @@ def eval_submission(submission, truth="/app/truth/translation"):
     values = []
     with open(os.path.join(truth, 'files.json')) as incoming:
         inputs = json.load(incoming)
-    for input_f in inputs:
-        input_files = [os.path.join(submission, 'images', 'translation', f) for f in eval(input_f)]
-        mapping = inputs[input_f]
-        scores = eval_mapping(mapping, input_files)
-        output[input_f] = scores
-        values.append(scores["sum"])
+    # decode every truth image in the mapping once, up front
+    tiff_dir = os.path.join(truth, 'translation')
+    get_truth_stack(tiff_dir).load(
+        [f for mapping in inputs.values() for f in mapping]
+    )
+    # pair scores are written in batches, so a restart resumes mid-submission
+    checkpoint = Checkpoint.for_folder("translation", submission, truth=truth)
+    # extracted images, or the kept zip read without extracting
+    with archive.Images(submission) as images:
+        for input_f in inputs:
+            input_files = [images.path('translation', f) for f in eval(input_f)]
+            mapping = inputs[input_f]
+            scores = eval_mapping(mapping, input_files, tiff_dir, checkpoint)
+            output[input_f] = scores
+            values.append(scores["sum"])
+        checkpoint.flush()
     output["average"] = avg(values)
     return output
 
 
+def score_submission(submission_path):
+    """
+    Scores one submission folder and records the scores in its metadata.json.
+    Inputs:
+        submission_path: String; path of the submission folder
+    Outputs:
+        average: float or None; average score, None if already evaluated
+    """
+    meta_path = os.path.join(submission_path, "metadata.json")
+    metadata = {
+            "team": os.path.basename(os.path.dirname(submission_path)),
+            "emails": [],
+            "timestamp": "",
+            "evaluated": False
+        }
+    try:
+        with open(meta_path) as incoming:
+            metadata = json.load(incoming)
+    except:
+        pass
+    if metadata["evaluated"]:
+        return None
+    logging.info(f"Eval {os.path.basename(submission_path)}")
+    score = eval_submission(submission_path)
+    metadata['score'] = score
+    metadata['evaluated'] = True
+    with open(meta_path, 'w') as output:
+        output.write(json.dumps(metadata, indent=2))
+    logging.info(f"Average: {score['average']}")
+    return score['average']
+
+
+def update_best(team, scores):
+    """
+    Puts the lowest of scores on the leaderboard if it beats the team's best.
+    """
+    if not scores:
+        return
+    this_best = min(scores, default=1000)
+    with Database("db/db.sqlite3") as db:
+        previous_best = db.get_translation_score_by_team(team)
+        if this_best < previous_best:
+            db.update_leaderboard(
+                "UPDATE ImageToImageScores SET score = ? WHERE team = ?",
+                (this_best, team)
+            )
+
+
 def eval_team(folder):
     team = os.path.basename(folder)
     logging.info(f"Eval Team: {team}")
     scores = []
     submission = os.listdir(folder)
     for submission in submission:
-        meta_path = os.path.join(folder, submission, "metadata.json")
-        metadata = {
-                "team": team,
-                "emails": [],
-                "timestamp": "",
-                "evaluated": False
-            }
-        try:
-            with open(meta_path) as incoming:
-                metadata = json.load(incoming)
-        except:
-            pass
-        if metadata["evaluated"]:
-            continue
-        logging.info(f"Eval {submission}")
         submission_path = os.path.join(folder, submission)
         try:
-            score = eval_submission(submission_path)
+            score = score_submission(submission_path)
         except Exception as e:
             logging.error(f'{e}')
             continue
-        metadata['score'] = score
-        metadata['evaluated'] = True
-        with open(meta_path, 'w') as output:
-            output.write(json.dumps(metadata, indent=2))
-        logging.info(f"Average: {score['average']}")
-        scores.append(score['average'])
-    if not scores:
-        return
-    this_best = min(scores, default=1000)
-    with Database("db/db.sqlite3") as db:
-        previous_best = db.get_translation_score_by_team(team)
-        if this_best < previous_best:
-            db.query(f"UPDATE ImageToImageScores SET score = {this_best} WHERE team = '{team}'")
+        if score is not None:
+            scores.append(score)
+    update_best(team, scores)
 
 
-@repeat(every(60).seconds)
 def main(path="/app/submissions/valid/translation"):
     os.makedirs(path, exist_ok=True)
     logging.info("Starting scan")
@@ -157,8 +304,15 @@ def main(path="/app/submissions/valid/translation"):
     logging.info("Done with scan")
 
 
-if __name__ == '__main__':
-    while True:
-        run_pending()
-        time.sleep(1)
+def handle_job(job, path="/app/submissions/valid/translation"):
+    # only the queued submission; failures are left to jobs.serve
+    logging.info(f"Eval Team: {job['team']}")
+    score = score_submission(os.path.join(path, job["team"], job["submission"]))
+    if score is not None:
+        update_best(job["team"], [score])
 
+
+if __name__ == '__main__':
+    # pick up anything saved while no evaluator was running
+    main()
+    jobs.serve("translation", handle_job)
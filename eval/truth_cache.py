@@ -0,0 +1,220 @@
+# built in
+import os
+import json
+import hashlib
+
+# 3rd party
+import numpy as np
+import rasterio
+
+# custom
+import scoring
+
+# logging
+import logging
+
+# loaded caches, keyed by (cache folder, truth folder)
+loaded = {}
+
+# tree hashes, keyed by truth folder, with the listing they were taken from
+tree_hashes = {}
+
+
+def file_hash(path):
+    """
+    Takes in a path and returns the sha1 of the file contents.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as incoming:
+        for block in iter(lambda: incoming.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_hash(truth_folder):
+    """
+    Takes in a truth folder and returns the sha1 of every file name and
+    content below it. Memoized against the (name, size, mtime) listing,
+    so an unchanged tree is only read once per process.
+    """
+    names = []
+    for root, dirs, files in os.walk(truth_folder):
+        for f in files:
+            names.append(os.path.relpath(os.path.join(root, f), truth_folder))
+    names.sort()
+    signature = []
+    for name in names:
+        stat = os.stat(os.path.join(truth_folder, name))
+        signature.append((name, stat.st_size, stat.st_mtime))
+    signature = tuple(signature)
+    cached = tree_hashes.get(truth_folder)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha1()
+    for name in names:
+        digest.update(f"{name}:{file_hash(os.path.join(truth_folder, name))}".encode())
+    tree_hashes[truth_folder] = (signature, digest.hexdigest())
+    return tree_hashes[truth_folder][1]
+
+
+def list_chips(truth_folder, f_type='.tiff'):
+    """
+    Takes in a truth folder and returns every chip below it, relative to it.
+    """
+    output = []
+    for root, dirs, files in os.walk(truth_folder):
+        for f in files:
+            if f_type in f:
+                output.append(os.path.relpath(os.path.join(root, f), truth_folder))
+    return sorted(output)
+
+
+class TruthMasks:
+    """
+    Packed binary truth masks for one truth folder, backed by a read-only
+    memory-mapped array so every evaluator process shares the same pages.
+    """
+    def __init__(self, truth_folder, index, masks):
+        self.truth_folder = truth_folder
+        self.index = index
+        self.masks = masks
+
+    def __contains__(self, path):
+        return self.key(path) in self.index["chips"]
+
+    def key(self, path):
+        return os.path.relpath(path, self.truth_folder)
+
+    def get(self, path):
+        """
+        Takes in the path of a truth chip and returns its boolean mask.
+        """
+        entry = self.index["chips"][self.key(path)]
+        offset, height, width = entry["offset"], entry["height"], entry["width"]
+        length = (height * width + 7) // 8
+        bits = self.masks[offset:offset + length]
+        return scoring.unpack_mask(bits, (height, width))
+
+
+def is_fresh(truth_folder, index):
+    """
+    Checks a cache index against the truth folder. A chip whose mtime moved
+    is re-hashed, so touching a file without changing it keeps the cache.
+    """
+    chips = index["chips"]
+    if list_chips(truth_folder) != sorted(chips):
+        return False
+    for chip, entry in chips.items():
+        path = os.path.join(truth_folder, chip)
+        stat = os.stat(path)
+        if stat.st_mtime == entry["mtime"] and stat.st_size == entry["size"]:
+            continue
+        if file_hash(path) != entry["sha1"]:
+            logging.info(f"Truth chip changed: {chip}")
+            return False
+        entry["mtime"] = stat.st_mtime
+        entry["size"] = stat.st_size
+    return True
+
+
+def build(truth_folder, cache_folder, normalize):
+    """
+    Decodes and normalizes every truth chip once, then writes the packed
+    masks and their index to cache_folder.
+    Inputs:
+        truth_folder: String; folder containing the truth tiffs
+        cache_folder: String; folder to write masks-<digest>.npy and index.json
+        normalize: function; takes a rasterio band, returns a binary mask
+    Outputs:
+        index: dictionary; chip -> offset, shape, mtime, size and sha1
+    """
+    logging.info(f"Building truth cache for {truth_folder}")
+    chips = {}
+    packed = []
+    offset = 0
+    digest = hashlib.sha1()
+    for chip in list_chips(truth_folder):
+        path = os.path.join(truth_folder, chip)
+        stat = os.stat(path)
+        with rasterio.open(path) as src:
+            mask = normalize(src.read(1))
+        bits = scoring.pack_mask(mask)
+        sha1 = file_hash(path)
+        chips[chip] = {
+            "offset": offset,
+            "height": mask.shape[0],
+            "width": mask.shape[1],
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "sha1": sha1
+        }
+        digest.update(f"{chip}:{sha1}".encode())
+        packed.append(bits)
+        offset += bits.size
+    os.makedirs(cache_folder, exist_ok=True)
+    masks_name = f"masks-{digest.hexdigest()}.npy"
+    masks_path = os.path.join(cache_folder, masks_name)
+    if not os.path.exists(masks_path):
+        tmp_path = f"{masks_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as outgoing:
+            np.save(outgoing, np.concatenate(packed) if packed else np.zeros(0, np.uint8))
+        os.replace(tmp_path, masks_path)
+    index = {
+        "truth_folder": truth_folder,
+        "masks": masks_name,
+        "chips": chips
+    }
+    write_index(cache_folder, index)
+    # drop mask files from older truth sets
+    for f in os.listdir(cache_folder):
+        if f.startswith("masks-") and f.endswith(".npy") and f != masks_name:
+            try:
+                os.remove(os.path.join(cache_folder, f))
+            except OSError:
+                pass
+    return index
+
+
+def write_index(cache_folder, index):
+    index_path = os.path.join(cache_folder, "index.json")
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as outgoing:
+        outgoing.write(json.dumps(index, indent=2))
+    os.replace(tmp_path, index_path)
+
+
+def read_index(cache_folder):
+    index_path = os.path.join(cache_folder, "index.json")
+    try:
+        with open(index_path) as incoming:
+            return json.load(incoming)
+    except (OSError, ValueError):
+        return None
+
+
+def load(truth_folder, cache_folder, normalize):
+    """
+    Returns the TruthMasks for truth_folder, building or rebuilding the
+    on-disk cache when any truth chip was added, removed or changed.
+    Inputs:
+        truth_folder: String; folder containing the truth tiffs
+        cache_folder: String; where the packed masks are kept
+        normalize: function; takes a rasterio band, returns a binary mask
+    Outputs:
+        masks: TruthMasks
+    """
+    key = (cache_folder, truth_folder)
+    index = read_index(cache_folder)
+    fresh = bool(index) and index.get("truth_folder") == truth_folder
+    if fresh:
+        mtimes = {chip: entry["mtime"] for chip, entry in index["chips"].items()}
+        fresh = is_fresh(truth_folder, index)
+        if fresh and mtimes != {chip: entry["mtime"] for chip, entry in index["chips"].items()}:
+            write_index(cache_folder, index)
+    if fresh and key in loaded and loaded[key].index["masks"] == index["masks"]:
+        return loaded[key]
+    if not fresh:
+        index = build(truth_folder, cache_folder, normalize)
+    masks = np.load(os.path.join(cache_folder, index["masks"]), mmap_mode='r')
+    loaded[key] = TruthMasks(truth_folder, index, masks)
+    return loaded[key]
@@ -6,8 +6,14 @@ from fire import fire
 from estimation import estimation
 from translation import translation
 from matrix_completion import matrix_completion
+from upload import UploadRequest
+import manifest
 
 app = Flask(__name__)
+# uploads are written to disk while the body is parsed
+app.request_class = UploadRequest
+# expected-file manifests, rebuilt only when the truth tree changes
+manifest.warm()
 
 @app.route("/")
 def home():
@@ -1,7 +1,12 @@
+# built in
+import os
+
 # settings for flask to use
 matrix_completion = {
     "image_type": ".tiff",
     "image_count": 5000,
+    "width": 256,
+    "height": 256,
 }
 
 estimation = {
@@ -19,10 +24,23 @@ fire = {
     "image_count": 500
 }
 
+storage = {
+    # extract submitted images to disk; when off the zip is kept as
+    # submission.zip and the evaluators read chips straight out of it
+    "extract": os.environ.get("EXTRACT_SUBMISSIONS", "true").lower() != "false",
+}
+
+verify = {
+    # threads reading image headers while a submission is verified
+    "workers": int(os.environ.get("VERIFY_WORKERS", 8)),
+}
+
 
 config = {
     "matrix_completion": matrix_completion,
     "estimation": estimation,
     "translation": translation,
-    "fire": fire
+    "fire": fire,
+    "storage": storage,
+    "verify": verify
 }
@@ -1,7 +1,9 @@
 # built in
-import sqlite3
 import os
 
+# custom
+import connections
+
 class Database:
     def __init__(self, path):
         # path to file
@@ -20,7 +22,9 @@ class Database:
         Enables the "with X as Y:" syntax
         """
         if not self.connection:
-            self.connection = sqlite3.connect(self.path)
+            # flask serves each request on a new thread, so connections
+            # come from the process-wide pool, WAL with a busy timeout
+            self.connection = connections.borrow(self.path)
             self.cursor = self.connection.cursor()
         return self
 
@@ -32,16 +36,18 @@ class Database:
             return
         else:
             self.connection.commit()
-            self.connection.close()
+            # the connection stays open for the next request
+            self.cursor.close()
+            connections.release(self.path, self.connection)
             self.connection = None
             self.cursor = None
 
-    def query(self, query_string):
-        self.cursor.execute(query_string)
+    def query(self, query_string, params=()):
+        self.cursor.execute(query_string, params)
         return self.cursor.fetchall()
 
     def get_top_matrix_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM MatrixCompletionScores ORDER BY lpips ASC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM MatrixCompletionScores ORDER BY lpips ASC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -55,7 +61,7 @@ class Database:
         return output
 
     def get_top_estimation_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM EstimationScores ORDER BY pixel DESC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM EstimationScores ORDER BY pixel DESC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -68,7 +74,7 @@ class Database:
         return output
 
     def get_top_translation_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM ImageToImageScores ORDER BY score ASC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM ImageToImageScores ORDER BY score ASC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -79,25 +85,25 @@ class Database:
         return output
         
     def get_completion_score_by_team(self, team):
-        self.cursor.execute(f"SELECT lpips FROM matrixcompletionscores WHERE team = '{team}';")
+        self.cursor.execute("SELECT lpips FROM matrixcompletionscores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO matrixcompletionscores (team, lpips, psnr, ssim) VALUES ('{team}', 1, 0, 0);")
+            self.cursor.execute("INSERT INTO matrixcompletionscores (team, lpips, psnr, ssim) VALUES (?, 1, 0, 0);", (team,))
             return 1
         else:
             return results[0][0]
 
     def get_estimation_score_by_team(self, team):
-        self.cursor.execute(f"SELECT pixel from EstimationScores WHERE team = '{team}';")
+        self.cursor.execute("SELECT pixel from EstimationScores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO EstimationScores (team, pixel, f1, iou) VALUES ('{team}', 0, 0, 0);")
+            self.cursor.execute("INSERT INTO EstimationScores (team, pixel, f1, iou) VALUES (?, 0, 0, 0);", (team,))
             return 1
         else:
             return results[0][0]
         
     def get_top_fire_scores(self, n=25):
-        self.cursor.execute(f"SELECT * FROM FireScores ORDER BY pixel DESC LIMIT {n};")
+        self.cursor.execute("SELECT * FROM FireScores ORDER BY pixel DESC LIMIT ?;", (n,))
         results = self.cursor.fetchall()
         output = []
         for row in results:
@@ -110,10 +116,10 @@ class Database:
         return output
 
     def get_fire_score_by_team(self, team):
-        self.cursor.execute(f"SELECT pixel from FireScores WHERE team = '{team}';")
+        self.cursor.execute("SELECT pixel from FireScores WHERE team = ?;", (team,))
         results = self.cursor.fetchall()
         if not results:
-            self.cursor.execute(f"INSERT INTO FireScores (team, pixel, f1, iou) VALUES ('{team}', 0, 0, 0);")
+            self.cursor.execute("INSERT INTO FireScores (team, pixel, f1, iou) VALUES (?, 0, 0, 0);", (team,))
             return 1
         else:
             return results[0][0]
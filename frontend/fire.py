@@ -11,6 +11,9 @@ import logging
 
 # custom
 import utils
+import manifest
+import leaderboard_cache
+from upload import receive
 from database import Database
 
 fire = Blueprint(
@@ -21,6 +24,11 @@ fire = Blueprint(
 
 @fire.route("/")
 def leaderboard():
+    # only re-rendered after an evaluator changed a score table
+    return leaderboard_cache.get(__name__, render_leaderboard)
+
+
+def render_leaderboard():
     with Database("db/db.sqlite3") as db:
         # top scores hidden
         top_scores = db.get_top_fire_scores()
@@ -40,22 +48,17 @@ def submit():
     # just in case
     os.makedirs("submissions/tmp", exist_ok=True)
     os.makedirs(f"submissions/valid/{__name__}", exist_ok=True)
-    # the zip file
-    zip_path = f"submissions/tmp/{team_name}.zip"
-    request.files["submission"].save(zip_path)
-    response = utils.verify(zip_path, __name__, '.tiff')
-    if not response["ok"]:
-        return response
-    # make the folder to extract to
-    utils.save(zip_path, __name__, team_name, emails)
+    # streamed to disk and indexed once, verify and save share the index
+    with receive(request.files["submission"]) as upload:
+        response = utils.verify(upload, __name__, '.tiff')
+        if not response["ok"]:
+            return response
+        # make the folder to extract to
+        utils.save(upload, __name__, team_name, emails)
     return redirect("/fire/", code=301)
 
 @fire.route('/api/expected-files')
 def get_expected_files():
     f_type = ".tiff"
-    files = utils.get_files("/app/truth/fire", f_type)
-    return {
-        "count": len(files),
-        "image_type": f_type,
-        "files": files
-    }
+    expected = manifest.get("/app/truth/fire", f_type)
+    return utils.expected_files_response(expected, f_type)
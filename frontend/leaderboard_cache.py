@@ -0,0 +1,32 @@
+# built in
+import os
+
+# rendered leaderboards, keyed by challenge: (version, page)
+pages = {}
+
+
+def version(path="db/leaderboard.version"):
+    """
+    Current leaderboard version, bumped by the evaluators whenever a score
+    table changes. The file is replaced on every bump, so its inode and
+    mtime identify the version without reading it or the database.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def get(challenge, render):
+    """
+    Returns the rendered leaderboard of challenge, only calling render()
+    to query the database and build the page when the version changed.
+    """
+    current = version()
+    cached = pages.get(challenge)
+    if cached is not None and cached[0] == current:
+        return cached[1]
+    page = render()
+    pages[challenge] = (current, page)
+    return page
@@ -0,0 +1,95 @@
+# built in
+import hashlib
+import json
+import os
+
+# manifests, keyed by (truth folder, file type)
+manifests = {}
+
+
+def get_files(path, f_type):
+    output = []
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            if f_type in f:
+                relative_path = os.path.join(root, f).replace(path, '')
+                output.append(relative_path)
+    return output
+
+
+def tree_signature(paths):
+    """
+    mtimes of paths and of the folders directly under them, which change
+    whenever a truth date/dataset folder or its files are added or removed.
+    """
+    output = []
+    for path in paths:
+        if not os.path.exists(path):
+            output.append((path, None))
+            continue
+        output.append((path, os.stat(path).st_mtime_ns))
+        if not os.path.isdir(path):
+            continue
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+            if entry.is_dir():
+                output.append((entry.path, entry.stat().st_mtime_ns))
+    return tuple(output)
+
+
+class Manifest:
+    """
+    Expected files of a challenge, built once and reused until the truth
+    tree changes.
+    """
+    def __init__(self, files, signature):
+        # listing order, as served by /api/expected-files
+        self.files = list(files)
+        # fire and estimation compare names lowercase
+        self.lowercase_files = [f.lower() for f in self.files]
+        self.signature = signature
+        self.etag = hashlib.sha1(json.dumps(self.files).encode()).hexdigest()
+
+
+def get(path, f_type):
+    """
+    Returns the manifest of f_type files under path, as listed by
+    get_files, rebuilding it only when the tree has changed.
+    """
+    key = (path, f_type)
+    signature = tree_signature([path])
+    manifest = manifests.get(key)
+    if manifest is None or manifest.signature != signature:
+        manifest = Manifest(get_files(path, f_type), signature)
+        manifests[key] = manifest
+    return manifest
+
+
+def get_translation(files_path="/app/truth/translation/files.json"):
+    """
+    Returns the manifest of translation inputs listed in files.json, as
+    /translation/<file> paths.
+    """
+    key = (files_path, None)
+    signature = tree_signature([files_path])
+    manifest = manifests.get(key)
+    if manifest is None or manifest.signature != signature:
+        with open(files_path) as incoming:
+            items = json.load(incoming)
+        files = []
+        for item in items:
+            for f in eval(item):
+                files.append(os.path.join('/translation', f))
+        manifest = Manifest(files, signature)
+        manifests[key] = manifest
+    return manifest
+
+
+def warm(truth="/app/truth"):
+    """
+    Builds every challenge's manifest up front, at startup.
+    """
+    for challenge in ["fire", "estimation", "matrix-completion"]:
+        get(os.path.join(truth, challenge), ".tiff")
+    files_path = os.path.join(truth, "translation", "files.json")
+    if os.path.exists(files_path):
+        get_translation(files_path)
@@ -0,0 +1,98 @@
+# built in
+import struct
+
+# bytes per value of each TIFF field type
+type_sizes = {
+    1: 1,   # BYTE
+    2: 1,   # ASCII
+    3: 2,   # SHORT
+    4: 4,   # LONG
+    5: 8,   # RATIONAL
+    6: 1,   # SBYTE
+    7: 1,   # UNDEFINED
+    8: 2,   # SSHORT
+    9: 4,   # SLONG
+    10: 8,  # SRATIONAL
+    11: 4,  # FLOAT
+    12: 8,  # DOUBLE
+    16: 8,  # LONG8, BigTIFF
+    17: 8,  # SLONG8, BigTIFF
+    18: 8,  # IFD8, BigTIFF
+}
+
+# struct codes of the integer field types the header tags use
+type_codes = {
+    1: "B",
+    3: "H",
+    4: "I",
+    16: "Q",
+}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+
+
+class TiffError(ValueError):
+    pass
+
+
+def read_at(stream, offset, size):
+    stream.seek(offset)
+    data = stream.read(size)
+    if len(data) != size:
+        raise TiffError("File is truncated")
+    return data
+
+
+def read_header(stream):
+    """
+    Reads the size of the first image of a TIFF from its header and first
+    IFD only, without decoding any pixels.
+    Inputs:
+        stream: file like; seekable, e.g. ZipFile.open
+    Outputs:
+        header: dictionary; width and height
+    """
+    start = read_at(stream, 0, 8)
+    if start[:2] == b"II":
+        order = "<"
+    elif start[:2] == b"MM":
+        order = ">"
+    else:
+        raise TiffError("Not a TIFF file")
+    magic = struct.unpack(f"{order}H", start[2:4])[0]
+    if magic == 42:
+        offset = struct.unpack(f"{order}I", start[4:8])[0]
+        count_format, entry_format, entry_size, inline = "H", "HHI4s", 12, 4
+    elif magic == 43:
+        offset = struct.unpack(f"{order}Q", read_at(stream, 8, 8))[0]
+        count_format, entry_format, entry_size, inline = "Q", "HHQ8s", 20, 8
+    else:
+        raise TiffError("Not a TIFF file")
+
+    count_size = struct.calcsize(count_format)
+    count = struct.unpack(f"{order}{count_format}", read_at(stream, offset, count_size))[0]
+    entries = read_at(stream, offset + count_size, count * entry_size)
+    tags = {}
+    for i in range(count):
+        tag, field_type, values, value = struct.unpack(
+            f"{order}{entry_format}",
+            entries[i * entry_size:(i + 1) * entry_size]
+        )
+        if tag not in (IMAGE_WIDTH, IMAGE_LENGTH):
+            continue
+        if field_type not in type_codes or not values:
+            raise TiffError(f"Unsupported type {field_type} for tag {tag}")
+        # both tags hold a single value
+        size = type_sizes[field_type]
+        if size * values > inline:
+            pointer = struct.unpack(f"{order}{'I' if inline == 4 else 'Q'}", value)[0]
+            value = read_at(stream, pointer, size)
+        tags[tag] = struct.unpack(f"{order}{type_codes[field_type]}", value[:size])[0]
+
+    if IMAGE_WIDTH not in tags or IMAGE_LENGTH not in tags:
+        raise TiffError("Image size is missing")
+    return {
+        "width": tags[IMAGE_WIDTH],
+        "height": tags[IMAGE_LENGTH]
+    }
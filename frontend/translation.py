@@ -12,6 +12,9 @@ import logging
 
 # custom
 import utils
+import manifest
+import leaderboard_cache
+from upload import receive
 from database import Database
 
 translation = Blueprint(
@@ -22,6 +25,11 @@ translation = Blueprint(
 
 @translation.route("/")
 def leaderboard():
+    # only re-rendered after an evaluator changed a score table
+    return leaderboard_cache.get(__name__, render_leaderboard)
+
+
+def render_leaderboard():
     with Database("db/db.sqlite3") as db:
         # top scores hidden
         top_scores = db.get_top_translation_scores()
@@ -41,27 +49,17 @@ def submit():
     # just in case
     os.makedirs("submissions/tmp", exist_ok=True)
     os.makedirs(f"submissions/valid/{__name__}", exist_ok=True)
-    # the zip file
-    zip_path = f"submissions/tmp/{team_name}.zip"
-    request.files["submission"].save(zip_path)
-    response = utils.verify_c3(zip_path, translation)
-    if not response["ok"]:
-        return response
-    # make the folder to extract to
-    utils.save(zip_path, __name__, team_name, emails)
+    # streamed to disk and indexed once, verify and save share the index
+    with receive(request.files["submission"]) as upload:
+        response = utils.verify_c3(upload, translation)
+        if not response["ok"]:
+            return response
+        # make the folder to extract to
+        utils.save(upload, __name__, team_name, emails)
     return redirect("/translation/", code=301)
 
 @translation.route('/api/expected-files')
 def get_expected_files():
     f_type = ".tiff"
-    with open('/app/truth/translation/files.json') as incoming:
-        items = json.load(incoming)
-    files = []
-    for key in items:
-        for f in eval(key):
-            files.append(os.path.join('/translation', f))
-    return {
-        "count": len(files),
-        "image_type": f_type,
-        "files": files
-    }
+    expected = manifest.get_translation()
+    return utils.expected_files_response(expected, f_type)
@@ -0,0 +1,167 @@
+# built in
+from zipfile import ZipFile
+import hashlib
+import uuid
+import os
+
+# 3rd party
+from flask import Request
+
+# chunk size used when copying and hashing uploads
+chunk_size = 1 << 20
+
+
+class HashingFile:
+    """
+    Writable file that keeps the sha1 and size of everything written to it.
+    Werkzeug writes uploads into it chunk by chunk while parsing the body.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        # set by receive, anything unclaimed is deleted with the request
+        self.claimed = False
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def discard(self):
+        self.file.close()
+        if not self.claimed and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def tmp_path():
+    # unique per upload, so concurrent uploads from one team never collide
+    os.makedirs("submissions/tmp", exist_ok=True)
+    return f"submissions/tmp/{uuid.uuid4().hex}.upload"
+
+
+class UploadRequest(Request):
+    """
+    Request that streams uploaded files straight to submissions/tmp,
+    hashing them on the way, instead of spooling them to a temp file.
+    Files no view claimed with receive() are deleted when the request
+    is closed, e.g. after a 400 for a missing form field.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_streams = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = HashingFile(tmp_path())
+        self.upload_streams.append(stream)
+        return stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for stream in self.upload_streams:
+                stream.discard()
+
+
+class Upload:
+    """
+    A submitted zip on disk, with its sha1 and central directory index.
+    The archive stays open so verification and saving share one index.
+    Unless it was moved into a submission, the zip is deleted on exit.
+    """
+    def __init__(self, path, sha1):
+        self.path = path
+        self.sha1 = sha1
+        self.kept = False
+        self.archive = ZipFile(path)
+        # member name -> ZipInfo
+        self.index = {info.filename: info for info in self.archive.infolist()}
+        self.names = list(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if not self.kept:
+            self.remove()
+
+    def close(self):
+        self.archive.close()
+
+    def open(self, name):
+        return self.archive.open(self.index[name])
+
+    def move(self, target):
+        """
+        Moves the zip to target, it stays readable through the open archive.
+        """
+        os.replace(self.path, target)
+        self.path = target
+        self.kept = True
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def receive(storage):
+    """
+    Claims an uploaded file and indexes it. The zip stays at its unique
+    path in submissions/tmp until save() moves or removes it.
+    Inputs:
+        storage: FileStorage; request.files entry
+    Outputs:
+        upload: Upload
+    """
+    stream = storage.stream
+    if isinstance(stream, HashingFile):
+        # already on disk, written while the request was parsed
+        stream.file.close()
+        stream.claimed = True
+        return open_upload(stream.path, stream.sha1.hexdigest())
+    # any other stream, e.g. from a plain Request
+    path = tmp_path()
+    sha1 = hashlib.sha1()
+    with open(path, 'wb') as output:
+        for block in iter(lambda: stream.read(chunk_size), b''):
+            sha1.update(block)
+            output.write(block)
+    return open_upload(path, sha1.hexdigest())
+
+
+def open_upload(path, sha1):
+    # a file that is not a zip is removed here, no Upload owns it yet
+    try:
+        return Upload(path, sha1)
+    except Exception:
+        os.remove(path)
+        raise
+
+
+def copy_member(upload, name, target=None):
+    """
+    Streams one member of the upload, writing it to target when given.
+    Outputs:
+        sha1: String; hex digest of the member
+    """
+    sha1 = hashlib.sha1()
+    with upload.open(name) as incoming:
+        output = None
+        if target:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            output = open(target, 'wb')
+        try:
+            for block in iter(lambda: incoming.read(chunk_size), b''):
+                sha1.update(block)
+                if output:
+                    output.write(block)
+        finally:
+            if output:
+                output.close()
+    return sha1.hexdigest()
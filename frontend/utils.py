@@ -1,71 +1,108 @@
 # built in
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import os
 import json
+import struct
+import zipfile
+import zlib
 
 #3rd Party
-from PIL import Image
 from flask import current_app
+from flask import jsonify
+from flask import request
 
 # custom
 from config import config
+from jobs import JobQueue
+import upload as uploads
+import manifest
+import tiff
 
-def get_files(path, f_type):
-    output = []
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            if f_type in f:
-                relative_path = os.path.join(root, f).replace(path, '')
-                output.append(relative_path)
-    return output
+def expected_files_response(expected, f_type):
+    """
+    Serves a manifest for /api/expected-files, answering 304 when the
+    client's ETag still matches.
+    """
+    response = jsonify({
+        "count": len(expected.files),
+        "image_type": f_type,
+        "files": expected.files
+    })
+    response.set_etag(expected.etag)
+    return response.make_conditional(request)
 
 
-def verify_c3(path, verify_path="/app/c3_files.json"):
+def verify_c3(upload, verify_path="/app/c3_files.json"):
     output = {
         "ok": True,
         "errors": []
     }
-    with ZipFile(path) as archive:
-        files = archive.namelist()
-    with open('/app/truth/translation/files.json') as incoming:
-        items = json.load(incoming)
-    for key in items:
-        for f in eval(key):
-            f_path = os.path.join('translation', f)
-            if f_path not in files:
-                output["ok"] = False
-                output["errors"].append(f"Missing file: {f_path}")
-                return output
+    files = upload.index
+    for f in manifest.get_translation().files:
+        f_path = f[1:]
+        if f_path not in files:
+            output["ok"] = False
+            output["errors"].append(f"Missing file: {f_path}")
+            return output
     return output
 
 
-def verify(path, challenge, f_type):
+def verify(upload, challenge, f_type):
     output = {
         "ok": True,
         "errors": []
     }
     if challenge == "translation": 
         return output
-    with ZipFile(path) as archive:
-        files = [f for f in archive.namelist()]
-        expected_files = get_files(f'/app/truth/{challenge}', f_type)
-        if challenge in ['fire', 'estimation']:
-            files = [f.lower() for f in files]
-            expected_files = [f.lower() for f in expected_files]
-        for f in expected_files:
-            f = f[1:]
-            if f not in files:
-                output["errors"].append(f'Missing file: {f}')
-                output["ok"] = False
-            if challenge == "matrix-completion":
-                img = Image.open(archive.open(f))
-                if img.height != 256 or img.width != 256:
-                    output["errors"].append(f'File {f} should be 256x256 but was {img.height}x{img.width}')
-                    output["ok"] = False
+    files = upload.index
+    expected = manifest.get(f'/app/truth/{challenge}', f_type)
+    expected_files = expected.files
+    if challenge in ['fire', 'estimation']:
+        files = frozenset(f.lower() for f in files)
+        expected_files = expected.lowercase_files
+    present = []
+    for f in expected_files:
+        f = f[1:]
+        if f not in files:
+            output["errors"].append(f'Missing file: {f}')
+            output["ok"] = False
+        else:
+            present.append(f)
+    if challenge == "matrix-completion":
+        errors = verify_dimensions(upload, present, config["matrix_completion"])
+        if errors:
+            output["errors"].extend(errors)
+            output["ok"] = False
     return output
 
 
+def check_dimensions(upload, f, expected):
+    """
+    Reads the TIFF header of one member and returns its errors, if any.
+    """
+    try:
+        with upload.open(f) as incoming:
+            header = tiff.read_header(incoming)
+    # a corrupt or truncated member is reported, not a server error
+    except (tiff.TiffError, zipfile.BadZipFile, zlib.error, struct.error, EOFError, NotImplementedError) as e:
+        return [f'File {f} could not be read: {e}']
+    errors = []
+    if header["height"] != expected["height"] or header["width"] != expected["width"]:
+        errors.append(f'File {f} should be {expected["height"]}x{expected["width"]} but was {header["height"]}x{header["width"]}')
+    return errors
+
+
+def verify_dimensions(upload, files, expected):
+    """
+    Checks the image size of every file from its TIFF header only, across
+    a thread pool, and returns every error found.
+    """
+    with ThreadPoolExecutor(config["verify"]["workers"]) as executor:
+        results = executor.map(lambda f: check_dimensions(upload, f, expected), files)
+        return [error for errors in results for error in errors]
+
+
 def lowercase_all_files(dir):
     starting_dir = os.getcwd()
     os.chdir(dir)
@@ -74,27 +111,56 @@ def lowercase_all_files(dir):
     os.chdir(starting_dir)
 
 
-def save(zip_path, challenge, team_name, emails):
+def save(upload, challenge, team_name, emails):
+    """
+    Stores a verified upload and queues it for evaluation. Every image is
+    read once from the open archive, extracted (unless disabled) and
+    hashed in the same pass.
+    """
     now = datetime.datetime.now()
-    team_folder = f"submissions/valid/{challenge}/{team_name}/{now.isoformat().replace(':', '-')}"
+    submission = now.isoformat().replace(':', '-')
+    team_folder = f"submissions/valid/{challenge}/{team_name}/{submission}"
     image_target = f"{team_folder}/images"
-    os.makedirs(image_target, exist_ok=True)
-    with ZipFile(zip_path) as archive:
-        files = archive.namelist()
-        to_extract = [f for f in files if config[challenge]["image_type"] in f]
-        archive.extractall(image_target, to_extract)
-    # all lowercase
-    if challenge in ['fire', 'estimation']:
-        lowercase_all_files(os.path.join(image_target, challenge))
+    os.makedirs(team_folder, exist_ok=True)
+    extract = config["storage"]["extract"]
+    lowercase = challenge in ['fire', 'estimation']
+    root = os.path.abspath(image_target)
+    hashes = {}
+    for name in upload.names:
+        if config[challenge]["image_type"] not in name or name.endswith('/'):
+            continue
+        target = None
+        if extract:
+            target = os.path.abspath(os.path.join(image_target, name))
+            # never write outside the submission
+            if not target.startswith(root + os.sep):
+                continue
+        hashes[name.lower() if lowercase else name] = uploads.copy_member(upload, name, target)
+    if extract:
+        os.makedirs(image_target, exist_ok=True)
+        # all lowercase
+        if lowercase:
+            lowercase_all_files(os.path.join(image_target, challenge))
+    else:
+        # kept as is, the evaluators stream chips out of the zip
+        upload.move(f"{team_folder}/submission.zip")
+    with open(f"{team_folder}/hashes.json", 'w') as output:
+        output.write(json.dumps(hashes, indent=2))
     with open(f"{team_folder}/metadata.json", 'w') as output:
         content = json.dumps(
             {
                 "team": team_name,
                 "emails": emails,
                 "timestamp": now.isoformat(),
+                "sha1": upload.sha1,
                 "evaluated": False
             },
             indent=2
         )
         output.write(content)
-    os.remove(zip_path)
+    upload.close()
+    if extract:
+        upload.remove()
+    # wake up the evaluator
+    with JobQueue("db/jobs.sqlite3") as queue:
+        queue.put(challenge, team_name, submission)